@@ -0,0 +1,263 @@
+"""Общий для всех процессов хоста кэш в файле SQLite.
+
+LocMemCache живёт внутри процесса: у каждого воркера gunicorn своя копия,
+и сброс кэша в одном воркере не виден остальным. SQLiteCache хранит
+записи в одном файле (режим WAL), поэтому воркеры делят данные
+и инвалидацию без внешнего сервиса.
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'core.cache.SQLiteCache',
+            'LOCATION': '/var/tmp/yatube-cache.sqlite3',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires REAL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+'''
+
+ALIVE = '(expires IS NULL OR expires > ?)'
+
+# Чаще раза в секунду время обращения к записи не обновляется:
+# для LRU этого достаточно, а чтение не превращается в запись.
+ACCESS_RESOLUTION = 1.0
+
+# INTEGER в SQLite — 64 бита со знаком; большие числа хранятся pickle.
+MIN_INTEGER = -2 ** 63
+MAX_INTEGER = 2 ** 63 - 1
+
+# Размер таблицы проверяется не на каждую запись, а раз в MAX_ENTRIES / 100
+# записанных потоком ключей: лимит превышается не больше чем на 1%
+# на поток, а запись не ждёт COUNT(*) под блокировкой.
+CULL_CHECK_SHARE = 100
+
+# Ключей в одном IN: старые сборки SQLite принимают до 999 параметров,
+# остаток оставлен под время и прочие параметры запроса.
+MAX_KEYS_PER_QUERY = 900
+
+
+def chunked(items, size=MAX_KEYS_PER_QUERY):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class SQLiteCache(BaseCache):
+    '''Кэш в файле SQLite с вытеснением давно не читавшихся записей (LRU).
+
+    Целые числа в пределах 64 бит хранятся как INTEGER, поэтому incr() —
+    один атомарный UPDATE; остальные значения сериализуются pickle.
+    '''
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self._path = os.path.abspath(location)
+        self._local = threading.local()
+        self._cull_every = max(1, self._max_entries // CULL_CHECK_SHARE)
+
+    @property
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            connection = sqlite3.connect(
+                self._path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def _encode(self, value):
+        if type(value) is int and MIN_INTEGER <= value <= MAX_INTEGER:
+            return value
+        return sqlite3.Binary(pickle.dumps(value, self.pickle_protocol))
+
+    @staticmethod
+    def _decode(value):
+        if isinstance(value, int):
+            return value
+        return pickle.loads(value)
+
+    def get(self, key, default=None, version=None):
+        return self.get_many([key], version=version).get(key, default)
+
+    def get_many(self, keys, version=None):
+        originals = {self._key(key, version): key for key in keys}
+        now = time.time()
+        found = {}
+        for chunk in chunked(list(originals)):
+            marks = ', '.join('?' * len(chunk))
+            rows = self._connection.execute(
+                f'SELECT key, value FROM cache '
+                f'WHERE key IN ({marks}) AND {ALIVE}',
+                [*chunk, now]
+            ).fetchall()
+            if rows:
+                hits = ', '.join('?' * len(rows))
+                self._connection.execute(
+                    f'UPDATE cache SET accessed = ? '
+                    f'WHERE key IN ({hits}) AND accessed < ?',
+                    [now, *(row[0] for row in rows),
+                     now - ACCESS_RESOLUTION]
+                )
+            found.update(
+                (originals[key], self._decode(value)) for key, value in rows)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.set_many({key: value}, timeout=timeout, version=version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expires = self.get_backend_timeout(timeout)
+        now = time.time()
+        rows = [
+            (self._key(key, version), self._encode(value), expires, now)
+            for key, value in data.items()
+        ]
+        connection = self._connection
+        with self._transaction(connection):
+            connection.executemany(
+                'INSERT OR REPLACE INTO cache (key, value, expires, accessed) '
+                'VALUES (?, ?, ?, ?)', rows)
+            self._cull(connection, now, len(rows))
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        now = time.time()
+        connection = self._connection
+        with self._transaction(connection):
+            connection.execute(
+                'DELETE FROM cache WHERE key = ? AND expires <= ?',
+                (key, now))
+            added = connection.execute(
+                'INSERT OR IGNORE INTO cache (key, value, expires, accessed) '
+                'VALUES (?, ?, ?, ?)',
+                (key, self._encode(value), self.get_backend_timeout(timeout),
+                 now)
+            ).rowcount
+            self._cull(connection, now, added)
+        return bool(added)
+
+    def incr(self, key, delta=1, version=None):
+        '''Сумма, которая помещается в INTEGER, считается одним UPDATE;
+        большие числа — в Python под той же блокировкой.'''
+        key = self._key(key, version)
+        now = time.time()
+        connection = self._connection
+        with self._transaction(connection):
+            if MIN_INTEGER <= delta <= MAX_INTEGER:
+                updated = connection.execute(
+                    f"UPDATE cache SET value = value + ?, accessed = ? "
+                    f"WHERE key = ? AND typeof(value) = 'integer' "
+                    f"AND value BETWEEN ? AND ? AND {ALIVE}",
+                    (delta, now, key, MIN_INTEGER - min(delta, 0),
+                     MAX_INTEGER - max(delta, 0), now)
+                ).rowcount
+                if updated:
+                    value, = connection.execute(
+                        'SELECT value FROM cache WHERE key = ?',
+                        (key,)).fetchone()
+                    return value
+            row = connection.execute(
+                f'SELECT value FROM cache WHERE key = ? AND {ALIVE}',
+                (key, now)).fetchone()
+            if row is None:
+                raise ValueError(f"Key '{key}' not found")
+            value = self._decode(row[0]) + delta
+            connection.execute(
+                'UPDATE cache SET value = ?, accessed = ? WHERE key = ?',
+                (self._encode(value), now, key))
+        return value
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        now = time.time()
+        return bool(self._connection.execute(
+            f'UPDATE cache SET expires = ?, accessed = ? '
+            f'WHERE key = ? AND {ALIVE}',
+            (self.get_backend_timeout(timeout), now, key, now)
+        ).rowcount)
+
+    def has_key(self, key, version=None):
+        return self._connection.execute(
+            f'SELECT 1 FROM cache WHERE key = ? AND {ALIVE}',
+            (self._key(key, version), time.time())
+        ).fetchone() is not None
+
+    def delete(self, key, version=None):
+        return self.delete_many([key], version=version)
+
+    def delete_many(self, keys, version=None):
+        keys = [self._key(key, version) for key in keys]
+        deleted = 0
+        for chunk in chunked(keys):
+            marks = ', '.join('?' * len(chunk))
+            deleted += self._connection.execute(
+                f'DELETE FROM cache WHERE key IN ({marks})', chunk).rowcount
+        return bool(deleted)
+
+    def clear(self):
+        self._connection.execute('DELETE FROM cache')
+
+    def close(self, **kwargs):
+        '''Соединение переиспользуется между запросами.'''
+
+    def _cull(self, connection, now, written):
+        '''Удаляет просроченное, а при переполнении — 1/CULL_FREQUENCY
+        записей, к которым дольше всего не обращались. Проверяется раз
+        в _cull_every записанных потоком ключей, см. CULL_CHECK_SHARE.'''
+        self._local.written = getattr(self._local, 'written', 0) + written
+        if self._local.written < self._cull_every:
+            return
+        self._local.written = 0
+        count, = connection.execute('SELECT COUNT(*) FROM cache').fetchone()
+        if count <= self._max_entries:
+            return
+        connection.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+        count, = connection.execute('SELECT COUNT(*) FROM cache').fetchone()
+        if count <= self._max_entries:
+            return
+        excess = count - self._max_entries
+        if self._cull_frequency:
+            excess = max(excess, count // self._cull_frequency)
+        else:
+            excess = count
+        connection.execute(
+            'DELETE FROM cache WHERE key IN '
+            '(SELECT key FROM cache ORDER BY accessed LIMIT ?)', (excess,))
+
+    @staticmethod
+    @contextmanager
+    def _transaction(connection):
+        '''BEGIN IMMEDIATE: блокировка на запись берётся сразу.'''
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
@@ -0,0 +1,72 @@
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+
+from core.cache import SQLiteCache
+
+
+def make_backend(name, location):
+    params = {'OPTIONS': {'MAX_ENTRIES': 100000}}
+    if name == 'locmem':
+        return LocMemCache('bench', params)
+    return SQLiteCache(location, params)
+
+
+def run_worker(name, location, operations, keys, seed, results):
+    '''Смесь чтений и записей: 90% get_many страницы ключей, 10% set.'''
+    cache = make_backend(name, location)
+    rng = random.Random(seed)
+    hits = reads = 0
+    started = time.perf_counter()
+    for _ in range(operations):
+        if rng.random() < 0.1:
+            cache.set(f'key:{rng.randrange(keys)}', 'x' * 512)
+        else:
+            page = [f'key:{rng.randrange(keys)}' for _ in range(10)]
+            hits += len(cache.get_many(page))
+            reads += len(page)
+    results.put((time.perf_counter() - started, hits, reads))
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает LocMemCache и SQLiteCache при нескольких '
+            'процессах-воркерах: пропускная способность и доля попаданий.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, nargs='+',
+                            default=[1, 2, 4, 8])
+        parser.add_argument('--operations', type=int, default=5000)
+        parser.add_argument('--keys', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        location = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+        self.stdout.write(
+            f'{"backend":<8} {"workers":>7} {"ops/s":>10} {"hit rate":>9}')
+        for workers in options['workers']:
+            for name in ('locmem', 'sqlite'):
+                if name == 'sqlite':
+                    make_backend(name, location).clear()
+                results = multiprocessing.Queue()
+                processes = [
+                    multiprocessing.Process(target=run_worker, args=(
+                        name, location, options['operations'],
+                        options['keys'], seed, results))
+                    for seed in range(workers)
+                ]
+                for process in processes:
+                    process.start()
+                stats = [results.get() for _ in processes]
+                for process in processes:
+                    process.join()
+                elapsed = max(stat[0] for stat in stats)
+                hits = sum(stat[1] for stat in stats)
+                reads = sum(stat[2] for stat in stats)
+                total = workers * options['operations']
+                self.stdout.write(
+                    f'{name:<8} {workers:>7} {total / elapsed:>10.0f} '
+                    f'{hits / reads:>9.1%}')
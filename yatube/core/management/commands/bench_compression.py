@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+from django.utils.text import compress_string
+
+from core.management.commands.bench_templates import make_posts
+from posts.caching import freeze, negotiate
+
+
+def feed_html(count):
+    '''Похоже на главную: одинаковая разметка карточек подряд.'''
+    cards = [
+        render_to_string('posts/includes/post_list.html', {'post': post})
+        for post in make_posts(count)
+    ]
+    return '<hr>'.join(cards)
+
+
+class Command(BaseCommand):
+    help = ('Процессорное время на запрос: без сжатия, сжатие на каждый '
+            'запрос (как GZipMiddleware) и готовые варианты из кэша.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--posts', type=int, default=10)
+
+    def handle(self, *args, **options):
+        content = feed_html(options['posts']).encode()
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip')
+        # Тип задан явно во всех режимах: без него Django 2.2 на каждый
+        # ответ читает устаревший DEFAULT_CONTENT_TYPE, и это дороже
+        # самого выбора варианта.
+        content_type = 'text/html; charset=utf-8'
+        cached = freeze(
+            request, HttpResponse(content, content_type=content_type))
+        modes = {
+            'none': lambda: HttpResponse(content, content_type=content_type),
+            'per-request': lambda: HttpResponse(
+                compress_string(content), content_type=content_type),
+            'precompressed': lambda: negotiate(request, cached),
+        }
+        self.stdout.write(
+            f'{"mode":<14} {"bytes":>8} {"CPU, µs/request":>16}')
+        for mode, serve in modes.items():
+            started = time.process_time()
+            for _ in range(options['requests']):
+                response = serve()
+            elapsed = time.process_time() - started
+            self.stdout.write(
+                f'{mode:<14} {len(response.content):>8} '
+                f'{elapsed / options["requests"] * 1e6:>16.1f}')
@@ -0,0 +1,81 @@
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.template import Context
+from django.template.backends.django import DjangoTemplates
+from django.test import RequestFactory
+
+from core.template_warmup import compile_templates, warm_up_templates
+from posts.models import Group, Post, User
+
+LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
+
+def make_engine(cached):
+    loaders = LOADERS
+    if cached:
+        loaders = [('django.template.loaders.cached.Loader', LOADERS)]
+    return DjangoTemplates({
+        'NAME': 'bench',
+        'DIRS': settings.TEMPLATES[0]['DIRS'],
+        'APP_DIRS': False,
+        'OPTIONS': {'loaders': loaders},
+    }).engine
+
+
+def make_posts(count):
+    '''Несохранённые посты: рендер без обращений к базе.'''
+    author = User(id=1, username='author')
+    group = Group(id=1, title='Группа', slug='group')
+    return [
+        Post(id=i, text=f'Текст поста {i}', author=author, group=group,
+             pub_date=datetime.now(), comment_count=i)
+        for i in range(1, count + 1)
+    ]
+
+
+def render_feed(engine, request, posts):
+    '''Как главная: страница и отдельная карточка на каждый пост.'''
+    for post in posts:
+        engine.get_template('posts/includes/post_list.html').render(
+            Context({'post': post}))
+    engine.get_template('posts/index.html').render(Context({
+        'request': request,
+        'user': request.user,
+        'page_obj': [],
+    }))
+
+
+class Command(BaseCommand):
+    help = ('Время рендера ленты на запрос: загрузчики без кэша '
+            'и cached.Loader до и после прогрева.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--posts', type=int, default=10)
+
+    def handle(self, *args, **options):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        posts = make_posts(options['posts'])
+        self.stdout.write(f'{"mode":<10} {"first, ms":>10} {"mean, ms":>10}')
+        for mode in ('plain', 'cached', 'warmed'):
+            engine = make_engine(cached=mode != 'plain')
+            if mode == 'warmed':
+                compile_templates(engine)
+            timings = []
+            for _ in range(options['requests']):
+                started = time.perf_counter()
+                render_feed(engine, request, posts)
+                timings.append(time.perf_counter() - started)
+            self.stdout.write(
+                f'{mode:<10} {timings[0] * 1000:>10.2f} '
+                f'{sum(timings) / len(timings) * 1000:>10.2f}')
+        self.stdout.write(
+            f'Прогрев текущего движка: {warm_up_templates()} шаблонов.')
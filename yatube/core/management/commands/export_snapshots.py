@@ -0,0 +1,156 @@
+import hashlib
+import json
+import multiprocessing
+import os
+from datetime import datetime
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import Client
+from django.urls import NoReverseMatch, reverse
+
+from posts.models import Group, Post, User
+
+MANIFEST = 'manifest.json'
+NGINX_MAP = 'snapshots.map'
+
+_client = None
+
+
+def snapshot_urls():
+    '''Адреса анонимных страниц: первые страницы лент, посты и «about».'''
+    yield reverse('posts:first')
+    yield reverse('about:author')
+    yield reverse('about:tech')
+    pages = (
+        ('posts:group_list', 'slug',
+         Group.objects.values_list('slug', flat=True)),
+        ('posts:profile', 'username',
+         User.objects.values_list('username', flat=True)),
+        ('posts:post_detail', 'post_id',
+         Post.objects.values_list('id', flat=True)),
+    )
+    for name, kwarg, values in pages:
+        for value in values.iterator():
+            try:
+                url = reverse(name, kwargs={kwarg: value})
+            except NoReverseMatch:
+                continue
+            if not {'.', '..'} & set(unquote(url).split('/')):
+                yield url
+
+
+def snapshot_path(url):
+    '''/group/slug/ -> group/slug/index.html'''
+    return os.path.join(unquote(url).strip('/'), 'index.html')
+
+
+def start_worker():
+    '''Соединения родителя после fork не переиспользуются.'''
+    global _client
+    connections.close_all()
+    _client = Client()
+
+
+def render_page(url):
+    '''Анонимный GET через весь стек Django, как от браузера.'''
+    global _client
+    if _client is None:
+        _client = Client()
+    response = _client.get(url)
+    if response.status_code != 200:
+        return url, response.status_code, None
+    return url, 200, response.content
+
+
+def write_atomically(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(content)
+    os.replace(temporary, path)
+
+
+class Command(BaseCommand):
+    help = ('Сохраняет анонимные страницы статическими файлами '
+            'для раздачи веб-сервером в обход Django.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=settings.SNAPSHOT_ROOT)
+        parser.add_argument('--processes', type=int, default=os.cpu_count())
+
+    def read_manifest(self, output):
+        try:
+            with open(os.path.join(output, MANIFEST)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def handle(self, *args, **options):
+        output = options['output']
+        previous = self.read_manifest(output)
+        urls = list(snapshot_urls())
+        manifest = {}
+        written = 0
+        if options['processes'] > 1:
+            connections.close_all()
+            pool = multiprocessing.Pool(
+                options['processes'], initializer=start_worker)
+            pages = pool.imap_unordered(render_page, urls, chunksize=16)
+        else:
+            pool = None
+            pages = map(render_page, urls)
+        try:
+            for url, status, content in pages:
+                if content is None:
+                    self.stderr.write(f'{url}: {status}, пропущена')
+                    continue
+                digest = hashlib.sha256(content).hexdigest()
+                entry = previous.get(url)
+                path = snapshot_path(url)
+                if (entry is None or entry['sha256'] != digest
+                        or not os.path.exists(os.path.join(output, path))):
+                    write_atomically(os.path.join(output, path), content)
+                    written += 1
+                    entry = {
+                        'path': path,
+                        'sha256': digest,
+                        'size': len(content),
+                        'generated': datetime.now().isoformat(),
+                    }
+                manifest[url] = entry
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        removed = 0
+        for url in previous.keys() - manifest.keys():
+            try:
+                os.remove(os.path.join(output, previous[url]['path']))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        self.write_manifest(output, manifest)
+        self.stdout.write(
+            f'Страниц: {len(manifest)}, записано: {written}, '
+            f'удалено: {removed}.')
+
+    def write_manifest(self, output, manifest):
+        '''manifest.json для инструментов и snapshots.map для nginx:
+
+            map $uri $snapshot { include snapshots.map; }
+            location / { root <output>; try_files $snapshot @django; }
+        '''
+        manifest = dict(sorted(manifest.items()))
+        write_atomically(
+            os.path.join(output, MANIFEST),
+            json.dumps(manifest, ensure_ascii=False, indent=2).encode())
+        lines = [
+            f'"{unquote(url)}" "/{entry["path"]}";'
+            for url, entry in manifest.items()
+        ]
+        write_atomically(
+            os.path.join(output, NGINX_MAP),
+            '\n'.join(lines + ['']).encode())
@@ -0,0 +1,150 @@
+"""Раздача MEDIA_ROOT приложением: картинки постов и миниатюры.
+
+Условный GET (ETag, If-Modified-Since), один диапазон Range и отдача
+файла через wsgi.file_wrapper: gunicorn пишет его в сокет os.sendfile
+без копирования в Python. Если перед приложением стоит nginx или Apache,
+тело отдаёт он сам по заголовку, а Django только проверяет путь:
+
+    MEDIA_SENDFILE = 'x-accel-redirect'
+    MEDIA_ACCEL_PREFIX = '/protected-media/'
+
+    location /protected-media/ { internal; alias <MEDIA_ROOT>/; }
+"""
+import mimetypes
+import os
+import posixpath
+import re
+import stat
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class FileRange:
+    '''Файл, из которого читается не больше length байт от текущей позиции.
+
+    fileno() оставлен: file_wrapper сервера отдаёт этот отрезок через
+    sendfile, беря смещение из позиции файла, а длину — из Content-Length.
+    '''
+
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        return self.file.tell()
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def close(self):
+        self.file.close()
+
+
+def file_etag(stat_result):
+    '''Как у nginx: размер и время изменения, без чтения файла.'''
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def requested_range(request, size, etag, last_modified):
+    '''(start, end) из заголовка Range включительно, None — весь файл,
+    False — диапазон вне файла.
+
+    Несколько диапазонов сразу не поддерживаются: отдаётся весь файл,
+    RFC 7233 это допускает. If-Range с другой версией — тоже весь файл.
+    '''
+    header = request.META.get('HTTP_RANGE', '').replace(' ', '')
+    match = RANGE.match(header)
+    if not match or match.groups() == ('', ''):
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag and (
+            parse_http_date_safe(if_range) != last_modified):
+        return None
+    first, last = match.groups()
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+def offload(response, path, fullpath):
+    '''Тело отдаёт фронтовой сервер; Range он обрабатывает сам.'''
+    mode = settings.MEDIA_SENDFILE
+    if mode == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = quote(
+            settings.MEDIA_ACCEL_PREFIX + path)
+    elif mode == 'x-sendfile':
+        response['X-Sendfile'] = fullpath
+    else:
+        return None
+    return response
+
+
+@require_safe
+def serve_media(request, path):
+    '''Файл из MEDIA_ROOT с условным GET, Range и отдачей через sendfile.'''
+    path = posixpath.normpath(path).lstrip('/')
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, path)
+        stat_result = os.stat(fullpath)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404('Файл не найден')
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise Http404('Файл не найден')
+    etag = file_etag(stat_result)
+    last_modified = int(stat_result.st_mtime)
+    content_type = mimetypes.guess_type(fullpath)[0]
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified,
+        response=HttpResponse(
+            content_type=content_type or 'application/octet-stream'))
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    patch_cache_control(
+        response, public=True, max_age=settings.MEDIA_CACHE_MAX_AGE)
+    if response.status_code != 200:
+        return response
+    if offload(response, path, fullpath):
+        return response
+    size = stat_result.st_size
+    byte_range = requested_range(request, size, etag, last_modified)
+    if byte_range is False:
+        response.status_code = 416
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+    start, end = byte_range or (0, size - 1)
+    file_response = FileResponse(
+        FileRange(open(fullpath, 'rb'), start, end - start + 1),
+        content_type=response['Content-Type'])
+    for header, value in response.items():
+        file_response[header] = value
+    file_response['Content-Length'] = end - start + 1
+    if byte_range:
+        file_response.status_code = 206
+        file_response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return file_response
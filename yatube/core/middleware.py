@@ -0,0 +1,22 @@
+from .query_budget import budget_of, count_queries, logger, repeated
+
+
+class QueryBudgetMiddleware:
+    '''Пишет в лог запросы, превысившие бюджет вьюхи, с повторами SQL.'''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with count_queries() as queries:
+            response = self.get_response(request)
+        match = request.resolver_match
+        budget = budget_of(match.func) if match else None
+        if budget is not None and len(queries) > budget:
+            logger.warning(
+                'Бюджет запросов превышен: %s %s — %d из %d.\n%s',
+                request.method, request.path, len(queries), budget,
+                '\n'.join(
+                    f'{count} × {sql}' for sql, count in repeated(queries))
+            )
+        return response
@@ -0,0 +1,50 @@
+import logging
+import re
+from collections import Counter
+from contextlib import contextmanager
+
+from django.db import connection
+
+logger = logging.getLogger('core.query_budget')
+
+NUMBERS = re.compile(r'\b\d+\b')
+STRINGS = re.compile(r"'(?:[^']|'')*'")
+
+
+def query_budget(max_queries):
+    '''Объявляет бюджет запросов к базе для вьюхи.'''
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+    return decorator
+
+
+def budget_of(view):
+    return getattr(view, 'query_budget', None)
+
+
+def normalize(sql):
+    '''Шаблон запроса без литералов, чтобы находить повторы (N+1).'''
+    return NUMBERS.sub('?', STRINGS.sub('?', sql))
+
+
+def repeated(queries, at_least=2):
+    '''Шаблоны запросов, выполненных не меньше at_least раз.'''
+    counts = Counter(normalize(sql) for sql in queries)
+    return [
+        (sql, count) for sql, count in counts.most_common()
+        if count >= at_least
+    ]
+
+
+@contextmanager
+def count_queries():
+    '''Собирает SQL всех запросов блока, работает и без DEBUG.'''
+    queries = []
+
+    def wrapper(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(wrapper):
+        yield queries
@@ -0,0 +1,39 @@
+import logging
+import os
+
+from django.template import TemplateSyntaxError, engines
+
+logger = logging.getLogger('core.template_warmup')
+
+
+def template_names(directory):
+    '''Имена всех шаблонов каталога в виде, понятном get_template().'''
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith('.html'):
+                path = os.path.relpath(os.path.join(root, name), directory)
+                yield path.replace(os.sep, '/')
+
+
+def compile_templates(engine):
+    '''Компилирует все шаблоны из DIRS движка, возвращает их число.'''
+    compiled = 0
+    for directory in engine.dirs:
+        for name in template_names(directory):
+            try:
+                engine.get_template(name)
+            except TemplateSyntaxError:
+                logger.exception('Шаблон %s не скомпилирован', name)
+            else:
+                compiled += 1
+    return compiled
+
+
+def warm_up_templates():
+    '''Компилирует шаблоны всех движков Django.
+
+    С cached.Loader скомпилированные шаблоны остаются в памяти процесса,
+    и первые запросы после выкладки не тратят время на разбор.
+    '''
+    return sum(
+        compile_templates(backend.engine) for backend in engines.all())
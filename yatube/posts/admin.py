@@ -24,6 +24,7 @@ class PostAdmin(admin.ModelAdmin):
         'pub_date',
         'author',
         'group',
+        'comment_count',
     )
     list_editable = ('group',)
     search_fields = ('text',)
@@ -0,0 +1,518 @@
+import gzip
+import math
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache, wraps
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.http import condition
+
+from .constants import POST_OBJECT_TIMEOUT
+from .models import Group, Post, User
+
+VERSION_TIMEOUT = None
+LOCK_TIMEOUT = 10
+LOCK_POLL_INTERVAL = 0.05
+# Версию держат под блокировкой на один get и set, дольше не ждём.
+VERSION_LOCK_WAIT = 1.0
+
+# Сдвигается при удалении любого поста: удаление не сбрасывает кэш лент,
+# но ETag страниц, где мог быть пост, должен смениться.
+REMOVED_FEED = 'removed'
+
+# Сжатие выполняется один раз при пересчёте страницы, а не на каждый
+# запрос, поэтому уровень максимальный. Порядок — предпочтение сервера.
+COMPRESSORS = {
+    'gzip': lambda content: gzip.compress(content, 9, mtime=0),
+    'deflate': lambda content: zlib.compress(content, 9),
+}
+MIN_COMPRESSED_LENGTH = 200
+
+# Заголовки, которые хранятся со страницей. Set-Cookie и всё, что ставят
+# middleware на конкретный запрос, в кэш не попадает.
+PAGE_HEADERS = ('Content-Type', 'Content-Language', 'Vary')
+
+# Исходы чтения копятся в памяти процесса и уходят в кэш не чаще раза
+# в METRICS_FLUSH_INTERVAL секунд: попадание в кэш не стоит двух записей.
+METRICS_FLUSH_INTERVAL = 10
+
+_executor = None
+_outcomes = Counter()
+_outcomes_lock = threading.Lock()
+_outcomes_flushed = time.monotonic()
+
+
+def version_key(name):
+    '''Ключ версии ленты: index, group:1, author:1, post:1...'''
+    return f'feed_version:{name}'
+
+
+def initial_version():
+    '''Новая версия не совпадает с вытесненной из кэша старой.'''
+    return int(time.time() * 1000)
+
+
+def feed_versions(names):
+    '''Текущие версии лент одним get_many; недостающие заводятся.'''
+    keys = [version_key(name) for name in names]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, initial_version(), VERSION_TIMEOUT)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def invalidate(*names):
+    '''Сдвигает версии перечисленных лент, старые записи перестают читаться.
+
+    Новая версия — max(текущее время в миллисекундах, старая + 1): по ней
+    же отдаётся Last-Modified, см. conditional_feed(). Чтение и запись
+    идут под короткой блокировкой, иначе два одновременных сдвига
+    уводят версию в будущее. Не дождавшись блокировки, версия
+    сдвигается атомарным incr() на единицу.
+    '''
+    for name in set(names):
+        key = version_key(name)
+        lock_key = f'lock:{key}'
+        if not acquire(lock_key):
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, initial_version(), VERSION_TIMEOUT)
+            continue
+        try:
+            old = cache.get(key)
+            now = initial_version()
+            cache.set(key, now if old is None else max(now, old + 1),
+                      VERSION_TIMEOUT)
+        finally:
+            cache.delete(lock_key)
+
+
+def acquire(lock_key, wait=VERSION_LOCK_WAIT):
+    '''Ждёт короткую блокировку через cache.add() не дольше wait секунд.'''
+    deadline = time.monotonic() + wait
+    while not cache.add(lock_key, 1, LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(LOCK_POLL_INTERVAL)
+    return True
+
+
+def post_feeds(post):
+    '''Ленты, на которые влияет пост, включая его прежнюю группу.'''
+    feeds = {'index', f'author:{post.author_id}', f'post:{post.id}'}
+    for group_id in (post.group_id, getattr(post, '_initial_group_id', None)):
+        if group_id is not None:
+            feeds.add(f'group:{group_id}')
+    return feeds
+
+
+def request_object(request, key, fetch):
+    '''Объект страницы, один запрос на ленты, ETag и саму вьюху:
+    первый вызов кладёт результат на request, следующие берут его там.'''
+    objects = request.__dict__.setdefault('_page_objects', {})
+    if key not in objects:
+        objects[key] = fetch()
+    return objects[key]
+
+
+def requested_group(request, slug):
+    return request_object(
+        request, ('group', slug),
+        lambda: Group.objects.filter(slug=slug).first())
+
+
+def requested_author(request, username):
+    return request_object(
+        request, ('author', username),
+        lambda: User.objects.filter(username=username).first())
+
+
+def requested_post(request, post_id):
+    return request_object(
+        request, ('post', post_id),
+        lambda: Post.objects.select_related(
+            'author', 'group').filter(id=post_id).first())
+
+
+def group_feeds(request, slug):
+    group = requested_group(request, slug)
+    return [] if group is None else [f'group:{group.id}']
+
+
+def post_object_key(post_id):
+    return f'post_object:{post_id}'
+
+
+def forget_posts(*post_ids):
+    '''Сбрасывает закэшированные объекты постов после правки.'''
+    cache.delete_many([post_object_key(post_id) for post_id in post_ids])
+
+
+def hydrate_posts(ids):
+    '''Посты с авторами и группами в порядке ids.
+
+    Объекты берутся одним get_many из кэша, недостающие — одним in_bulk
+    с select_related и кладутся обратно. Удалённые посты пропускаются.
+    '''
+    keys = {post_object_key(post_id): post_id for post_id in ids}
+    posts = {
+        keys[key]: post for key, post in cache.get_many(list(keys)).items()}
+    missing = [post_id for post_id in ids if post_id not in posts]
+    if missing:
+        fetched = Post.objects.select_related(
+            'author', 'group').in_bulk(missing)
+        cache.set_many({
+            post_object_key(post_id): post
+            for post_id, post in fetched.items()
+        }, POST_OBJECT_TIMEOUT)
+        posts.update(fetched)
+    return [posts[post_id] for post_id in ids if post_id in posts]
+
+
+def profile_feeds(request, username):
+    '''Лента автора и подписки читателя: от них зависит счётчик подписок.'''
+    author = requested_author(request, username)
+    if author is None:
+        return []
+    feeds = [f'author:{author.id}']
+    if request.user.is_authenticated:
+        feeds.append(f'follow:{request.user.id}')
+    return feeds
+
+
+def post_detail_feeds(request, post_id):
+    '''Пост с комментариями и лента автора ради счётчика его постов.'''
+    post = requested_post(request, post_id)
+    if post is None:
+        return []
+    return [f'post:{post.id}', f'author:{post.author_id}']
+
+
+def feed_names(feeds, request, kwargs):
+    '''Имена лент вьюхи; вычисляются один раз за запрос.'''
+    if not callable(feeds):
+        return list(feeds)
+    if not hasattr(request, '_feed_names'):
+        request._feed_names = list(feeds(request, **kwargs))
+    return request._feed_names
+
+
+def page_key(view_name, request, versions=None):
+    '''Ключ страницы; без versions — последняя отрисованная копия.'''
+    path = md5(request.get_full_path().encode()).hexdigest()
+    user_id = request.user.id if request.user.is_authenticated else 0
+    if versions is None:
+        versions = 'latest'
+    else:
+        versions = '.'.join(str(version) for version in versions)
+    return f'feed_page:{view_name}:{versions}:{user_id}:{path}'
+
+
+def should_refresh_early(expires, delta, beta):
+    '''Вероятностное раннее обновление (XFetch): чем дольше пересчёт
+    и ближе истечение, тем вероятнее, что запрос обновит запись заранее.'''
+    jitter = delta * beta * math.log(1 - random.random())
+    return time.time() - jitter >= expires
+
+
+def count_outcome(metric, outcome):
+    '''Счётчик исходов чтения: fresh, stale (отдана устаревшая копия), miss.
+
+    Считается в памяти процесса, в кэш сбрасывается flush_outcomes();
+    при остановке процесса теряется не больше METRICS_FLUSH_INTERVAL секунд.
+    '''
+    if metric is None:
+        return
+    with _outcomes_lock:
+        _outcomes[f'feed_metrics:{metric}:{outcome}'] += 1
+    if time.monotonic() - _outcomes_flushed >= METRICS_FLUSH_INTERVAL:
+        flush_outcomes()
+
+
+def flush_outcomes():
+    '''Прибавляет накопленные процессом исходы к счётчикам в кэше.'''
+    global _outcomes_flushed
+    with _outcomes_lock:
+        pending = dict(_outcomes)
+        _outcomes.clear()
+        _outcomes_flushed = time.monotonic()
+    for key, count in pending.items():
+        if not cache.add(key, count, None):
+            try:
+                cache.incr(key, count)
+            except ValueError:
+                cache.set(key, count, None)
+
+
+def feed_metrics(metric):
+    '''Сколько раз вьюха отдала свежую, устаревшую копию и пересчитала.'''
+    flush_outcomes()
+    outcomes = ('fresh', 'stale', 'miss')
+    values = cache.get_many(
+        [f'feed_metrics:{metric}:{outcome}' for outcome in outcomes])
+    return {
+        outcome: values.get(f'feed_metrics:{metric}:{outcome}', 0)
+        for outcome in outcomes
+    }
+
+
+def refresh_executor():
+    '''Общий пул потоков для фонового пересчёта устаревших записей.'''
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.FEED_REFRESH_WORKERS,
+            thread_name_prefix='feed-refresh')
+    return _executor
+
+
+def store(key, compute, timeout, stale_key, keep_for, cacheable):
+    started = time.monotonic()
+    value = compute()
+    if cacheable is None or cacheable(value):
+        entry = (value, time.time() + timeout, time.monotonic() - started)
+        entries = {key: entry}
+        if stale_key is not None:
+            entries[stale_key] = entry
+        cache.set_many(entries, timeout + keep_for)
+    return value
+
+
+def refresh_in_background(lock_key, *args):
+    '''Пересчёт в пуле; запрос, поставивший задачу, не ждёт.'''
+    def job():
+        try:
+            store(*args)
+        finally:
+            cache.delete(lock_key)
+            connections.close_all()
+    refresh_executor().submit(job)
+
+
+def get_or_recompute(key, compute, timeout, stale_key=None, beta=1.0,
+                     lock_timeout=LOCK_TIMEOUT, cacheable=None,
+                     stale_for=0, metric=None):
+    '''Значение из кэша с защитой от одновременного пересчёта (stampede).
+
+    Запись хранится как (значение, срок свежести, время пересчёта) и живёт
+    после истечения ещё stale_for секунд (или timeout, если stale_for = 0).
+    Пересчитывает только запрос, взявший короткую
+    блокировку через cache.add(); остальные получают устаревшую копию —
+    из key или из stale_key, куда кладётся последняя отрисовка независимо
+    от версий. Без копии ждут пересчёт не дольше lock_timeout.
+
+    stale_for > 0 включает stale-while-revalidate: истёкшая по времени
+    запись отдаётся сразу, а пересчёт уходит в фоновый пул потоков.
+    '''
+    keep_for = stale_for or timeout
+    keys = [key] if stale_key is None else [key, stale_key]
+    entries = cache.get_many(keys)
+    entry = entries.get(key)
+    lock_key = f'lock:{key}'
+    if entry is not None:
+        value, expires, delta = entry
+        if not should_refresh_early(expires, delta, beta):
+            count_outcome(metric, 'fresh')
+            return value
+        if stale_for and time.time() < expires + stale_for:
+            if cache.add(lock_key, 1, lock_timeout):
+                refresh_in_background(
+                    lock_key, key, compute, timeout, stale_key, keep_for,
+                    cacheable)
+            count_outcome(metric, 'stale')
+            return value
+    stale = entry or entries.get(stale_key)
+    locked = cache.add(lock_key, 1, lock_timeout)
+    if not locked:
+        if stale is not None:
+            count_outcome(metric, 'stale')
+            return stale[0]
+        deadline = time.monotonic() + lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[0]
+    count_outcome(metric, 'miss')
+    try:
+        return store(key, compute, timeout, stale_key, keep_for, cacheable)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+
+
+def freeze(request, response):
+    '''Тело, безопасные заголовки и сжатые варианты ответа для кэша.
+
+    Ответ, который ставит cookies или отдаёт CSRF-токен (сессия,
+    csrftoken), не кэшируется: None, он уходит только своему запросу.
+    Сжатие выполняется здесь, один раз на пересчёт страницы.
+    '''
+    if (response.status_code != 200 or response.streaming
+            or response.cookies or request.META.get('CSRF_COOKIE_USED')):
+        return None
+    content = response.content
+    headers = {
+        header: response[header]
+        for header in PAGE_HEADERS if response.has_header(header)
+    }
+    compressed = {}
+    if ('Content-Encoding' not in response
+            and len(content) >= MIN_COMPRESSED_LENGTH):
+        compressed = {
+            coding: compress(content)
+            for coding, compress in COMPRESSORS.items()
+        }
+        patch_vary_headers(response, ('Accept-Encoding',))
+        headers['Vary'] = response['Vary']
+    return {'content': content, 'headers': headers, 'compressed': compressed}
+
+
+def accepted_encodings(request):
+    '''Кодировки из Accept-Encoding, кроме запрещённых через q=0.'''
+    return parse_accept_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+
+
+@lru_cache(maxsize=64)
+def parse_accept_encoding(header):
+    '''Браузеры шлют несколько одинаковых заголовков: разбор кэшируется.'''
+    accepted = set()
+    for item in header.split(','):
+        coding, _, params = item.strip().lower().partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip())
+    return frozenset(accepted)
+
+
+def negotiate(request, page):
+    '''Ответ из закэшированной страницы: сжатый вариант, если клиент
+    его принимает, иначе исходное тело.'''
+    content, encoding = page['content'], None
+    if page['compressed']:
+        accepted = accepted_encodings(request)
+        for coding, variant in page['compressed'].items():
+            if coding in accepted:
+                content, encoding = variant, coding
+                break
+    headers = page['headers']
+    response = HttpResponse(content, content_type=headers.get('Content-Type'))
+    for header, value in headers.items():
+        if header != 'Content-Type':
+            response[header] = value
+    if encoding is not None:
+        response['Content-Encoding'] = encoding
+        response['Content-Length'] = str(len(content))
+    return response
+
+
+def feed_cache_options(view_name, kwargs):
+    options = settings.FEED_CACHE.get(view_name)
+    if options is None:
+        return None
+    slugs = options.get('slugs')
+    if slugs is not None and kwargs.get('slug') not in slugs:
+        return None
+    return options
+
+
+def cache_feed(feeds, beta=1.0):
+    '''Кэширует GET-ответ вьюхи под версиями лент, замена cache_page.
+
+    feeds — кортеж имён лент или функция (request, **kwargs) -> имена.
+    Ответ перестаёт читаться, как только invalidate() сдвинет версию
+    любой из этих лент; остальной кэш не трогается. Пересчёт защищён
+    от лавины запросов, см. get_or_recompute().
+
+    Сроки берутся из settings.FEED_CACHE по имени вьюхи: fresh — сколько
+    ответ свежий, stale — сколько ещё его можно отдавать, пока он
+    пересчитывается в фоне; slugs, если задан, ограничивает кэш
+    перечисленными группами, без него кэшируются все. Вьюхи без настроек
+    не кэшируются.
+
+    В кэш кладутся только тело, безопасные заголовки и gzip- и
+    deflate-варианты тела (freeze), ответ собирается заново на каждый
+    запрос; клиенту отдаётся принятый им вариант без сжатия на запросе.
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            options = feed_cache_options(view.__name__, kwargs)
+            if request.method not in ('GET', 'HEAD') or options is None:
+                return view(request, *args, **kwargs)
+            names = feed_names(feeds, request, kwargs)
+
+            def render():
+                response = view(request, *args, **kwargs)
+                return freeze(request, response) or response
+
+            page = get_or_recompute(
+                page_key(view.__name__, request, feed_versions(names)),
+                render,
+                options['fresh'],
+                stale_key=page_key(view.__name__, request),
+                beta=beta,
+                cacheable=lambda page: isinstance(page, dict),
+                stale_for=options.get('stale', 0),
+                metric=view.__name__,
+            )
+            if isinstance(page, HttpResponse):
+                return page
+            return negotiate(request, page)
+        return wrapper
+    return decorator
+
+
+def conditional_feed(feeds):
+    '''Условный GET по версиям лент: ETag и Last-Modified без запроса
+    страницы и шаблонов.
+
+    feeds — как в cache_feed(). ETag складывается из версий лент,
+    пользователя (шапка страницы у каждого своя) и CSRF-токена: формы
+    на странице несут его, а вход в систему его меняет. Last-Modified —
+    наибольшая версия, она же время последнего изменения. Совпавший
+    If-None-Match или If-Modified-Since получает 304 до вызова вьюхи.
+    Если лент нет (группы или поста не существует), проверка
+    пропускается и вьюха сама отвечает 404.
+    '''
+    def versions(request, kwargs):
+        names = feed_names(feeds, request, kwargs)
+        if not names:
+            return None
+        return feed_versions(names + [REMOVED_FEED])
+
+    def etag(request, *args, **kwargs):
+        current = versions(request, kwargs)
+        if current is None:
+            return None
+        user_id = request.user.id if request.user.is_authenticated else 0
+        token = request.META.get('CSRF_COOKIE', '')
+        raw = '.'.join(str(version) for version in current)
+        raw = f'{raw}:{user_id}:{token}'
+        return f'W/"{md5(raw.encode()).hexdigest()}"'
+
+    def last_modified(request, *args, **kwargs):
+        current = versions(request, kwargs)
+        if current is None:
+            return None
+        return datetime.fromtimestamp(max(current) / 1000, timezone.utc)
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
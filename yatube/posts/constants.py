@@ -1,3 +1,15 @@
 VIEW_LIST_COUNT_OF_PAGINATOR = 10
 POSTS_COUNT_FOR_TEST = 13
 MAX_LEN_OF_STRING = 15
+MAX_NUMBERED_PAGES = 10
+FEED_COUNT_TIMEOUT = 60 * 5
+COUNT_ESTIMATE_FROM = 10000
+PAGE_WINDOW_ON_EACH_SIDE = 2
+PAGE_WINDOW_ON_ENDS = 1
+CARD_CACHE_TIMEOUT = 60 * 60
+FEED_IDS_TIMEOUT = 60 * 5
+POST_OBJECT_TIMEOUT = 60 * 60
+COMMENTS_PER_PAGE = 20
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+MAX_UPLOAD_PIXELS = 50_000_000
+MAX_MASTER_SIDE = 2048
@@ -0,0 +1,114 @@
+import logging
+from io import BytesIO
+
+from django import forms
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from PIL import Image, ImageOps
+from sorl.thumbnail import delete
+from sorl.thumbnail.images import ImageFile
+
+from .constants import MAX_MASTER_SIDE, MAX_UPLOAD_BYTES, MAX_UPLOAD_PIXELS
+from .models import StoredImage
+from .storage import image_storage
+
+logger = logging.getLogger('posts.images')
+
+EXIF_ORIENTATION = 0x0112
+SAVE_OPTIONS = {
+    'JPEG': {'quality': 90, 'optimize': True, 'progressive': True},
+    'PNG': {'optimize': True},
+    'WEBP': {'quality': 90},
+}
+# Снимки телефонов в MPO — JPEG с дополнительными кадрами (превью,
+# стереопара). Пересохраняется основной кадр; писать MPO Pillow 8 не умеет.
+SAVE_FORMATS = {'MPO': 'JPEG'}
+
+
+def acquire(name):
+    '''Ещё один пост ссылается на файл.'''
+    if not name:
+        return
+    if StoredImage.objects.filter(name=name).update(refs=F('refs') + 1):
+        return
+    try:
+        with transaction.atomic():
+            StoredImage.objects.create(name=name, refs=1)
+    except IntegrityError:
+        StoredImage.objects.filter(name=name).update(refs=F('refs') + 1)
+
+
+def release(name):
+    '''Пост больше не ссылается на файл. Файл без ссылок удаляется вместе
+    с миниатюрами после фиксации транзакции.'''
+    if not name:
+        return
+    StoredImage.objects.filter(name=name, refs__gt=0).update(
+        refs=F('refs') - 1)
+    if StoredImage.objects.filter(name=name, refs=0).delete()[0]:
+        transaction.on_commit(lambda: remove_file(name))
+
+
+def remove_file(name):
+    '''Удаляет файл, его миниатюры и их записи в KVStore.
+
+    Ссылки перепроверяются под блокировкой: пока удаление ждало фиксации,
+    такую же картинку могли загрузить снова, и файл снова нужен.
+    '''
+    try:
+        with transaction.atomic():
+            if StoredImage.objects.select_for_update().filter(
+                    name=name, refs__gt=0).exists():
+                return
+            delete(ImageFile(name, image_storage))
+    except (OSError, SuspiciousFileOperation):
+        logger.exception('Файл %s не удалён', name)
+
+
+def ingest(upload):
+    '''Проверяет загрузку и при необходимости пересохраняет её
+    уменьшенным мастером не больше MAX_MASTER_SIDE с учтённой ориентацией.
+
+    Размеры берутся из заголовка, до декодирования пикселей; JPEG
+    декодируется сразу в уменьшенном масштабе (draft), остальное —
+    через reduce(), поэтому память не зависит от размера оригинала.
+    Подходящий файл возвращается как есть: одинаковые загрузки остаются
+    одинаковыми байтами.
+    '''
+    if upload.size > MAX_UPLOAD_BYTES:
+        raise forms.ValidationError(
+            'Файл больше %(limit)d МБ.',
+            params={'limit': MAX_UPLOAD_BYTES // (1024 * 1024)},
+            code='file_too_large')
+    upload.seek(0)
+    try:
+        image = Image.open(upload)
+        width, height = image.size
+        if width * height > MAX_UPLOAD_PIXELS:
+            raise forms.ValidationError(
+                'Картинка больше %(limit)d мегапикселей.',
+                params={'limit': MAX_UPLOAD_PIXELS // 1_000_000},
+                code='too_many_pixels')
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+        oversized = max(width, height) > MAX_MASTER_SIDE
+        format_ = SAVE_FORMATS.get(image.format, image.format)
+        animated = getattr(image, 'is_animated', False) and (
+            image.format not in SAVE_FORMATS)
+        if animated or not (oversized or orientation != 1):
+            upload.seek(0)
+            return upload
+        image.thumbnail(
+            (MAX_MASTER_SIDE, MAX_MASTER_SIDE), Image.LANCZOS,
+            reducing_gap=2.0)
+        image = ImageOps.exif_transpose(image)
+        if format_ == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        content = BytesIO()
+        image.save(content, format_, **SAVE_OPTIONS.get(format_, {}))
+    except (OSError, KeyError, ValueError, Image.DecompressionBombError):
+        raise forms.ValidationError(
+            'Не удалось прочитать картинку.', code='invalid_image')
+    return SimpleUploadedFile(
+        upload.name, content.getvalue(), upload.content_type)
@@ -0,0 +1,76 @@
+import hashlib
+import multiprocessing
+import os
+import re
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from posts.models import Post
+from posts.storage import addressed_name, image_storage
+
+DIRECTORY = 'posts'
+ADDRESSED = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{64}\.[^/]*$')
+
+
+def stored_names(directory):
+    '''Имена файлов каталога, ещё не разложенных по хэшу.'''
+    root = image_storage.path(directory)
+    for path, _, filenames in os.walk(root):
+        for filename in filenames:
+            relative = os.path.relpath(
+                os.path.join(path, filename), root).replace(os.sep, '/')
+            if not ADDRESSED.match(relative):
+                yield f'{directory}/{relative}'
+
+
+def file_digest(name):
+    hasher = hashlib.sha256()
+    with open(image_storage.path(name), 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            hasher.update(chunk)
+    return name, hasher.hexdigest()
+
+
+class Command(BaseCommand):
+    help = ('Переносит картинки постов в хранилище по хэшу содержимого: '
+            'одинаковые файлы сливаются в один.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count())
+
+    def handle(self, *args, **options):
+        names = list(stored_names(DIRECTORY))
+        if options['processes'] > 1:
+            connections.close_all()
+            with multiprocessing.Pool(options['processes']) as pool:
+                digests = list(
+                    pool.imap_unordered(file_digest, names, chunksize=16))
+        else:
+            digests = list(map(file_digest, names))
+        groups = defaultdict(list)
+        for name, digest in digests:
+            extension = os.path.splitext(name)[1]
+            groups[addressed_name(DIRECTORY, digest, extension)].append(name)
+        moved = relinked = 0
+        for target, sources in sorted(groups.items()):
+            posts = Post.objects.filter(image__in=sources)
+            if not posts.exists():
+                continue
+            if not image_storage.exists(target):
+                source = image_storage.path(sources[0])
+                os.makedirs(os.path.dirname(image_storage.path(target)),
+                            exist_ok=True)
+                os.replace(source, image_storage.path(target))
+                moved += 1
+            # Сигналы постов переносят ссылки на новый файл, а старые
+            # файлы и их миниатюры удаляются, когда ссылок не остаётся.
+            with transaction.atomic():
+                for post in posts:
+                    post.image.name = target
+                    post.save(update_fields=['image', 'updated'])
+                    relinked += 1
+        self.stdout.write(
+            f'Файлов: {len(names)}, уникальных: {len(groups)}, '
+            f'перенесено: {moved}, постов обновлено: {relinked}.')
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from posts.models import Comment, Post
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает Post.comment_count одним GROUP BY по комментариям.'
+
+    def handle(self, *args, **options):
+        counts = dict(
+            Comment.objects.order_by().values_list('post_id')
+            .annotate(comments=Count('id'))
+        )
+        drifted = [
+            Post(id=post_id, comment_count=counts.get(post_id, 0))
+            for post_id, stored in Post.objects.order_by().values_list(
+                'id', 'comment_count').iterator()
+            if stored != counts.get(post_id, 0)
+        ]
+        Post.objects.bulk_update(drifted, ['comment_count'], batch_size=500)
+        self.stdout.write(
+            f'Исправлено счётчиков комментариев: {len(drifted)}')
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from posts.stats import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Сверяет счётчики профилей (UserStats) с постами и подписками.'
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Исправлено счётчиков профилей: {reconcile()}')
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.16 on 2026-10-18 16:42
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_comment_count(apps, schema_editor):
+    Comment = apps.get_model('posts', 'Comment')
+    Post = apps.get_model('posts', 'Post')
+    counts = (
+        Comment.objects.order_by().values_list('post_id')
+        .annotate(comments=Count('id'))
+    )
+    Post.objects.bulk_update(
+        [Post(id=post_id, comment_count=count) for post_id, count in counts],
+        ['comment_count'],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0015_auto_20261018_1642'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Количество комментариев'),
+        ),
+        migrations.RunPython(fill_comment_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.16 on 2026-10-18 17:04
+
+from django.db import migrations, models
+from django.db.models import Count
+import posts.storage
+
+
+def fill_refs(apps, schema_editor):
+    Post = apps.get_model('posts', 'Post')
+    StoredImage = apps.get_model('posts', 'StoredImage')
+    counts = (
+        Post.objects.exclude(image='').order_by().values_list('image')
+        .annotate(refs=Count('id'))
+    )
+    StoredImage.objects.bulk_create(
+        [StoredImage(name=name, refs=refs) for name, refs in counts],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0019_comment_post_created'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredImage',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False, verbose_name='Файл')),
+                ('refs', models.PositiveIntegerField(default=0, verbose_name='Ссылок')),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='image',
+            field=models.ImageField(blank=True, storage=posts.storage.ContentAddressedStorage(), upload_to='posts/', verbose_name='Картинка'),
+        ),
+        migrations.RunPython(fill_refs, migrations.RunPython.noop),
+    ]
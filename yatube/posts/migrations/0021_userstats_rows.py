@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count
+
+
+def create_rows(apps, schema_editor):
+    '''Записи счётчиков для пользователей, созданных до сигнала.'''
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    Post = apps.get_model('posts', 'Post')
+    Follow = apps.get_model('posts', 'Follow')
+    UserStats = apps.get_model('posts', 'UserStats')
+    sources = {
+        'posts_count': Post.objects.values_list('author_id'),
+        'followers_count': Follow.objects.values_list('author_id'),
+        'following_count': Follow.objects.values_list('user_id'),
+    }
+    counts = {}
+    for field, queryset in sources.items():
+        for user_id, count in queryset.order_by().annotate(
+                total=Count('id')):
+            counts.setdefault(user_id, {})[field] = count
+    missing = User.objects.exclude(
+        id__in=UserStats.objects.values('user_id')).values_list(
+            'id', flat=True)
+    UserStats.objects.bulk_create(
+        [UserStats(user_id=user_id, **counts.get(user_id, {}))
+         for user_id in missing.iterator()],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('posts', '0020_storedimage'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_rows, migrations.RunPython.noop),
+    ]
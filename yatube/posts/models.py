@@ -3,6 +3,7 @@ from django.contrib.auth import get_user_model
 
 from core.models import CreatedModel
 from posts.constants import MAX_LEN_OF_STRING as MAX_LEN
+from posts.storage import image_storage
 
 User = get_user_model()
 
@@ -36,20 +37,44 @@ class Post(models.Model):
     image = models.ImageField(
         'Картинка',
         upload_to='posts/',
-        blank=True
+        storage=image_storage,
+        blank=True,
+        db_index=True
     )
     pub_date = models.DateTimeField(
         'Дата создания',
         auto_now_add=True,
         db_index=True
     )
+    updated = models.DateTimeField(
+        'Дата изменения',
+        auto_now=True
+    )
+    comment_count = models.PositiveIntegerField(
+        'Количество комментариев',
+        default=0,
+        editable=False
+    )
 
     class Meta:
         ordering = ['-pub_date']
+        indexes = [
+            models.Index(
+                fields=('author', '-pub_date'), name='post_author_pub_date'),
+        ]
 
     def __str__(self):
         return self.text[:MAX_LEN]
 
+    def save(self, *args, **kwargs):
+        '''comment_count меняется только атомарно, его не перезаписываем.'''
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'comment_count'
+            ]
+        super().save(*args, **kwargs)
+
 
 class Comment(CreatedModel):
     post = models.ForeignKey(
@@ -66,6 +91,11 @@ class Comment(CreatedModel):
 
     class Meta:
         ordering = ['-created']
+        indexes = [
+            models.Index(
+                fields=('post', '-created', '-id'),
+                name='comment_post_created'),
+        ]
 
     def __str__(self):
         return self.text
@@ -91,3 +121,55 @@ class Follow(CreatedModel):
             models.CheckConstraint(check=~models.Q(user=models.F(
                 'author')), name='dont_follow_your_self'),
         ]
+
+
+class TimelineEntry(models.Model):
+    '''Запись ленты подписок, создаётся при публикации (fan-out on write).'''
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='timeline'
+    )
+    post = models.ForeignKey(
+        Post,
+        on_delete=models.CASCADE,
+        related_name='timeline_entries'
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    pub_date = models.DateTimeField('Дата создания поста')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=(
+                'user', 'post'), name='unique_timeline_entry'),
+        ]
+        indexes = [
+            models.Index(
+                fields=('user', '-pub_date', '-post'),
+                name='timeline_user_pub_date'),
+            models.Index(
+                fields=('user', 'author'), name='timeline_user_author'),
+        ]
+
+
+class UserStats(models.Model):
+    '''Счётчики пользователя для профиля, обновляются сигналами.'''
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='stats'
+    )
+    posts_count = models.PositiveIntegerField('Постов', default=0)
+    followers_count = models.PositiveIntegerField('Подписчиков', default=0)
+    following_count = models.PositiveIntegerField('Подписок', default=0)
+
+
+class StoredImage(models.Model):
+    '''Файл картинки и число постов, которые на него ссылаются.'''
+    name = models.CharField('Файл', max_length=100, primary_key=True)
+    refs = models.PositiveIntegerField('Ссылок', default=0)
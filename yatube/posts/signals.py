@@ -0,0 +1,159 @@
+import threading
+
+from django.db.models import F
+from django.db.models.functions import Now
+from django.db.models.signals import (
+    post_delete, post_init, post_save, pre_delete
+)
+from django.dispatch import receiver
+
+from . import images, stats, timeline
+from .caching import REMOVED_FEED, forget_posts, invalidate, post_feeds
+from .models import Comment, Group, Post, Follow, User, UserStats
+from .utils import invalidate_feed_members
+
+_deleting = threading.local()
+
+# Поля, которые выводятся в карточках и на страницах постов.
+USER_LABELS = {'username', 'first_name', 'last_name'}
+
+
+def deleting_posts():
+    '''id постов, которые удаляются в этом потоке прямо сейчас.'''
+    if not hasattr(_deleting, 'ids'):
+        _deleting.ids = set()
+    return _deleting.ids
+
+
+def image_name(post):
+    '''Имя файла картинки; None, если поле не загружено (only/defer).'''
+    value = post.__dict__.get('image')
+    return getattr(value, 'name', value)
+
+
+@receiver(post_save, sender=User)
+def user_created(sender, instance, created, **kwargs):
+    '''Счётчики заводятся сразу: bump() не теряет сдвиги.'''
+    if created:
+        UserStats.objects.get_or_create(user=instance)
+
+
+def relabel(posts, *feeds):
+    '''Имя автора или название группы сменилось: объекты постов в кэше
+    держат старое, а страницы с ними должны сменить ETag.
+
+    Кроме лент самих постов сдвигаются ленты всех групп и авторов этих
+    постов: имя автора видно на страницах групп, название группы —
+    в профилях авторов.
+    '''
+    rows = list(posts.values_list('id', 'author_id', 'group_id'))
+    forget_posts(*(post_id for post_id, _, _ in rows))
+    related = set()
+    for post_id, author_id, group_id in rows:
+        related.update((f'post:{post_id}', f'author:{author_id}'))
+        if group_id is not None:
+            related.add(f'group:{group_id}')
+    invalidate(*feeds, *related)
+
+
+@receiver(post_save, sender=User)
+def user_renamed(sender, instance, created, update_fields, **kwargs):
+    if created or update_fields and not USER_LABELS & set(update_fields):
+        return
+    relabel(Post.objects.filter(author=instance),
+            'index', f'author:{instance.id}')
+
+
+@receiver(post_save, sender=Group)
+def group_renamed(sender, instance, created, **kwargs):
+    if not created:
+        relabel(Post.objects.filter(group=instance),
+                'index', f'group:{instance.id}')
+
+
+@receiver(post_init, sender=Post)
+def remember_initial_state(sender, instance, **kwargs):
+    '''Запоминает исходные группу и картинку: при смене группы
+    сбрасываются обе ленты, при смене картинки — ссылки на файлы.'''
+    instance._initial_group_id = instance.__dict__.get('group_id')
+    instance._initial_image = image_name(instance)
+
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, **kwargs):
+    if created:
+        stats.bump(instance.author_id, posts_count=1)
+        timeline.fan_out(instance)
+    if created or instance.group_id != instance._initial_group_id:
+        invalidate_feed_members(*post_feeds(instance))
+    invalidate(*post_feeds(instance))
+    forget_posts(instance.id)
+    image, initial_image = image_name(instance), instance._initial_image
+    if created:
+        images.acquire(image)
+    elif None not in (image, initial_image) and image != initial_image:
+        images.acquire(image)
+        images.release(initial_image)
+    instance._initial_group_id = instance.group_id
+    instance._initial_image = image
+
+
+@receiver(pre_delete, sender=Post)
+def post_deleting(sender, instance, **kwargs):
+    '''pre_delete приходит до каскада: комментарии удаляемого поста
+    не трогают его счётчик и кэш, см. comment_deleted().'''
+    deleting_posts().add(instance.id)
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    deleting_posts().discard(instance.id)
+    stats.bump(instance.author_id, posts_count=-1)
+    invalidate_feed_members(*post_feeds(instance))
+    invalidate(REMOVED_FEED)
+    forget_posts(instance.id)
+    images.release(image_name(instance))
+
+
+@receiver(post_save, sender=Comment)
+def comment_created(sender, instance, created, **kwargs):
+    if created:
+        Post.objects.filter(id=instance.post_id).update(
+            comment_count=F('comment_count') + 1, updated=Now())
+        invalidate(*post_feeds(instance.post))
+        forget_posts(instance.post_id)
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, **kwargs):
+    if instance.post_id in deleting_posts():
+        return
+    Post.objects.filter(id=instance.post_id, comment_count__gt=0).update(
+        comment_count=F('comment_count') - 1, updated=Now())
+    invalidate(*post_feeds(instance.post))
+    forget_posts(instance.post_id)
+
+
+@receiver(post_save, sender=Follow)
+def follow_created(sender, instance, created, **kwargs):
+    if not created:
+        return
+    stats.bump(instance.author_id, followers_count=1)
+    stats.bump(instance.user_id, following_count=1)
+    invalidate_feed_members(f'follow:{instance.user_id}')
+    invalidate(f'follow:{instance.user_id}', f'author:{instance.author_id}')
+    timeline.backfill(instance)
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    stats.bump(instance.author_id, followers_count=-1)
+    stats.bump(instance.user_id, following_count=-1)
+    invalidate_feed_members(f'follow:{instance.user_id}')
+    invalidate(f'follow:{instance.user_id}', f'author:{instance.author_id}')
+    timeline.remove(instance)
+    feeds = [f'follow:{user_id}'
+             for user_id in timeline.demote(instance.author_id)]
+    if feeds:
+        invalidate_feed_members(*feeds)
+        invalidate(*feeds)
@@ -0,0 +1,76 @@
+from django.db import IntegrityError
+from django.db.models import Count, F
+
+from .models import Follow, Post, User, UserStats
+
+
+def bump(user_id, **deltas):
+    '''Атомарно сдвигает счётчики пользователя: bump(1, posts_count=1).
+
+    Запись заводится вместе с пользователем (signals.user_created)
+    и миграцией для старых пользователей. Её нет только во время
+    каскадного удаления пользователя — тогда сдвиг не нужен.
+    '''
+    guards = {
+        f'{field}__gte': -delta
+        for field, delta in deltas.items() if delta < 0
+    }
+    UserStats.objects.filter(user_id=user_id, **guards).update(**{
+        field: F(field) + delta for field, delta in deltas.items()})
+
+
+def count_for(user_id):
+    return {
+        'posts_count': Post.objects.filter(author_id=user_id).count(),
+        'followers_count': Follow.objects.filter(author_id=user_id).count(),
+        'following_count': Follow.objects.filter(user_id=user_id).count(),
+    }
+
+
+def stats_for(user_id):
+    '''Счётчики пользователя. Запись есть у каждого пользователя;
+    для созданных в обход сигналов она считается по базе.'''
+    stats = UserStats.objects.filter(user_id=user_id).first()
+    if stats is not None:
+        return stats
+    try:
+        return UserStats.objects.create(user_id=user_id, **count_for(user_id))
+    except IntegrityError:
+        return UserStats.objects.get(user_id=user_id)
+
+
+def grouped_counts():
+    '''Все счётчики тремя GROUP BY: {user_id: {поле: значение}}.'''
+    sources = {
+        'posts_count': Post.objects.values_list('author_id'),
+        'followers_count': Follow.objects.values_list('author_id'),
+        'following_count': Follow.objects.values_list('user_id'),
+    }
+    counts = {}
+    for field, queryset in sources.items():
+        for user_id, count in queryset.order_by().annotate(
+                total=Count('id')):
+            counts.setdefault(user_id, {})[field] = count
+    return counts
+
+
+def reconcile():
+    '''Пересчитывает UserStats всех пользователей, возвращает число правок.'''
+    counts = grouped_counts()
+    existing = UserStats.objects.in_bulk()
+    fields = ('posts_count', 'followers_count', 'following_count')
+    created, drifted = [], []
+    for user_id in User.objects.values_list('id', flat=True).iterator():
+        actual = dict.fromkeys(fields, 0)
+        actual.update(counts.get(user_id, {}))
+        stats = existing.get(user_id)
+        if stats is None:
+            created.append(UserStats(user_id=user_id, **actual))
+        elif any(getattr(stats, field) != actual[field] for field in fields):
+            for field in fields:
+                setattr(stats, field, actual[field])
+            drifted.append(stats)
+    UserStats.objects.bulk_create(
+        created, batch_size=500, ignore_conflicts=True)
+    UserStats.objects.bulk_update(drifted, fields, batch_size=500)
+    return len(created) + len(drifted)
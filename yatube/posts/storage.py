@@ -0,0 +1,57 @@
+import hashlib
+import os
+import posixpath
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+def content_digest(content):
+    '''sha256 содержимого файла, позиция чтения возвращается в начало.'''
+    hasher = hashlib.sha256()
+    for chunk in content.chunks():
+        hasher.update(chunk)
+    content.seek(0)
+    return hasher.hexdigest()
+
+
+def addressed_name(directory, digest, extension):
+    '''posts/ + ab/abcdef….gif: первые два символа — подкаталог.'''
+    return posixpath.join(
+        directory, digest[:2], f'{digest}{extension.lower()}')
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    '''Хранилище, где имя файла — хэш его содержимого.
+
+    Одинаковые загрузки ложатся в один файл: повторная запись не
+    выполняется, и sorl делает миниатюры для него один раз. Сколько постов
+    ссылается на файл, считает posts.images.
+    '''
+
+    def save(self, name, content, max_length=None):
+        directory, filename = posixpath.split(name)
+        name = addressed_name(
+            directory, content_digest(content),
+            os.path.splitext(filename)[1])
+        if self.exists(name):
+            return name
+        try:
+            return super().save(name, content, max_length=max_length)
+        except FileExistsError:
+            # Тот же файл только что записала параллельная загрузка.
+            return name
+
+    def get_available_name(self, name, max_length=None):
+        '''Суффиксов нет: занятое имя значит, что файл уже сохранён.
+
+        Исключение ловит save(); оно же прерывает повтор в _save(),
+        когда файл создан между проверкой и открытием.
+        '''
+        if self.exists(name):
+            raise FileExistsError(name)
+        return name
+
+
+image_storage = ContentAddressedStorage()
@@ -0,0 +1,52 @@
+from hashlib import md5
+
+from django import template
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from posts.constants import CARD_CACHE_TIMEOUT
+from posts.thumbnails import prefetch_thumbnails
+
+register = template.Library()
+
+CARD_TEMPLATE = 'posts/includes/post_list.html'
+
+
+def card_key(post, hide_group):
+    '''Ключ карточки меняется при правке поста, комментарии, смене группы
+    и при переименовании автора или группы: их имена выводятся в карточке.'''
+    group = post.group
+    labels = (
+        post.author.username, post.author.get_full_name(),
+        group.slug if group else '', group.title if group else '',
+    )
+    digest = md5('\n'.join(labels).encode()).hexdigest()
+    return (
+        f'post_card:{post.id}:{post.updated.timestamp()}:'
+        f'{post.comment_count}:{post.group_id}:{int(hide_group)}:{digest}'
+    )
+
+
+@register.simple_tag(takes_context=True)
+def post_cards(context, posts):
+    '''HTML карточек постов страницы: одним get_many из кэша, недостающие
+    рендерятся и кладутся обратно одним set_many. Миниатюры для них
+    читаются из KVStore одним обращением, см. prefetch_thumbnails().'''
+    request = context.get('request')
+    match = getattr(request, 'resolver_match', None)
+    hide_group = match is not None and match.view_name == 'posts:group_list'
+    posts = list(posts)
+    keys = [card_key(post, hide_group) for post in posts]
+    cards = cache.get_many(keys)
+    prefetch_thumbnails(
+        post for key, post in zip(keys, posts) if key not in cards)
+    missing = {}
+    for key, post in zip(keys, posts):
+        if key not in cards:
+            missing[key] = render_to_string(
+                CARD_TEMPLATE, {'post': post, 'hide_group': hide_group})
+    if missing:
+        cache.set_many(missing, CARD_CACHE_TIMEOUT)
+        cards.update(missing)
+    return [mark_safe(cards[key]) for key in keys]
@@ -0,0 +1,16 @@
+from django import template
+
+from posts.thumbnails import THUMBNAIL_ASPECT, responsive_sources
+
+register = template.Library()
+
+
+@register.inclusion_tag('posts/includes/picture.html')
+def picture(image, sizes='100vw'):
+    '''<picture> с WebP и JPEG нескольких ширин: браузер скачивает
+    наименьший подходящий файл. Пока миниатюры не готовы — заглушка.'''
+    return {
+        'picture': responsive_sources(image),
+        'sizes': sizes,
+        'aspect': THUMBNAIL_ASPECT,
+    }
@@ -0,0 +1,16 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+
+# Тесты не пишут в рабочий файл кэша: у прогона свой во временном каталоге.
+TEST_CACHE_DIR = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, TEST_CACHE_DIR, ignore_errors=True)
+TEST_CACHES = {
+    'default': {
+        **settings.CACHES['default'],
+        'LOCATION': os.path.join(TEST_CACHE_DIR, 'cache.sqlite3'),
+    }
+}
@@ -1,10 +1,31 @@
-from django.test import Client, TestCase
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, TestCase, override_settings
 from django.urls import reverse
 from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
-from posts.models import Group, Post, User
+from core.cache import SQLiteCache
+from posts.caching import (
+    feed_metrics, freeze, get_or_recompute, hydrate_posts, invalidate,
+    post_object_key, version_key
+)
+from posts.models import Comment, Group, Post, User
+from posts.tests import TEST_CACHES
+from posts.utils import feed_count_key
 
 
+@override_settings(CACHES=TEST_CACHES)
 class PostModelTest(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -36,3 +57,348 @@ class PostModelTest(TestCase):
         post_list2 = response.content
         self.assertEqual(post_list, post_list1)
         self.assertNotEqual(post_list, post_list2)
+
+    def test_feed_count_is_cached_and_invalidated(self):
+        """Количество постов ленты берётся из кэша и сбрасывается
+            при создании поста."""
+        group = Group.objects.create(
+            title='Группа для подсчёта',
+            slug='count_slug',
+            description='Тестовое описание',
+        )
+        key = feed_count_key(f'group:{group.id}')
+        url = reverse('posts:group_list', kwargs={'slug': group.slug})
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertFalse([
+            query for query in queries
+            if 'COUNT(' in query['sql'] and 'FROM "posts_post"' in query['sql']
+        ])
+        self.assertEqual(cache.get(key), 0)
+        Post.objects.create(
+            author=self.user, group=group, text='Пост в группе')
+        self.assertIsNone(cache.get(key))
+
+    def test_post_card_cached_until_comment(self):
+        """Карточка поста берётся из кэша и обновляется после комментария."""
+        cache.clear()
+        url = reverse('posts:profile', kwargs={'username': self.user})
+        response = self.client.get(url)
+        self.assertTemplateUsed(response, 'posts/includes/post_list.html')
+        response = self.client.get(url)
+        self.assertTemplateNotUsed(response, 'posts/includes/post_list.html')
+        self.assertContains(response, 'Комментариев: 0')
+        Comment.objects.create(
+            post=self.post, author=self.user, text='Комментарий')
+        response = self.client.get(url)
+        self.assertContains(response, 'Комментариев: 1')
+
+    def test_post_card_follows_author_and_group_renames(self):
+        """Карточка и объект поста обновляются при переименовании
+            автора и группы."""
+        cache.clear()
+        group = Group.objects.create(
+            title='Старое название', slug='renamed', description='')
+        post = Post.objects.create(
+            author=self.user, group=group, text='Пост в группе')
+        url = reverse('posts:profile', kwargs={'username': self.user})
+        self.client.get(url)
+        self.user.first_name, self.user.last_name = 'Лев', 'Толстой'
+        self.user.save()
+        group.title = 'Новое название'
+        group.save()
+        response = self.client.get(url)
+        self.assertContains(response, 'Лев Толстой')
+        self.assertContains(response, 'Группа: Новое название')
+        self.assertEqual(
+            cache.get(post_object_key(post.id)).group.title,
+            'Новое название')
+
+    def test_renames_change_etags_of_related_feeds(self):
+        """Переименование автора меняет ETag его групп, переименование
+            группы — ETag профилей её авторов."""
+        group = Group.objects.create(
+            title='Группа', slug='related', description='')
+        Post.objects.create(author=self.user, group=group, text='Пост')
+        group_url = reverse('posts:group_list', kwargs={'slug': group.slug})
+        profile_url = reverse(
+            'posts:profile', kwargs={'username': self.user})
+        etag = self.client.get(group_url)['ETag']
+        self.user.first_name = 'Новое имя'
+        self.user.save()
+        self.assertEqual(self.client.get(
+            group_url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        etag = self.client.get(profile_url)['ETag']
+        group.title = 'Новое название'
+        group.save()
+        self.assertEqual(self.client.get(
+            profile_url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_post_edit_invalidates_only_its_feeds(self):
+        """Правка поста сбрасывает кэш главной, не очищая весь кэш."""
+        cache.set('unrelated', 'value')
+        url = reverse('posts:first')
+        self.authorized_client.get(url)
+        self.authorized_client.post(
+            reverse('posts:post_edit', kwargs={'post_id': self.post.id}),
+            data={'text': 'Отредактированный текст'},
+        )
+        self.assertContains(
+            self.authorized_client.get(url), 'Отредактированный текст')
+        self.assertEqual(cache.get('unrelated'), 'value')
+
+    def test_feed_ids_cached_and_posts_hydrated(self):
+        """Лента берёт id страницы из кэша, посты — из кэша объектов;
+            правка сбрасывает только объект поста."""
+        cache.clear()
+        url = reverse('posts:profile', kwargs={'username': self.user})
+        self.client.get(url)
+        self.assertIsNotNone(cache.get(post_object_key(self.post.id)))
+        Post.objects.filter(id=self.post.id).update(text='Другой текст')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(hydrate_posts([self.post.id])[0].text,
+                             self.post.text)
+        self.assertEqual(len(queries), 0)
+        self.post.text = 'Отредактированный текст'
+        self.post.save()
+        self.assertIsNone(cache.get(post_object_key(self.post.id)))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertContains(response, 'Отредактированный текст')
+        self.assertFalse([
+            query for query in queries
+            if query['sql'].startswith('SELECT "posts_post"."id", '
+                                       '"posts_post"."pub_date"')
+        ])
+
+    def test_cached_page_served_precompressed(self):
+        """Сжатый вариант страницы берётся из кэша без сжатия на запросе."""
+        url = reverse('posts:first')
+        plain = self.client.get(url)
+        self.assertNotIn('Content-Encoding', plain)
+        with mock.patch('posts.caching.gzip.compress', side_effect=self.fail):
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING='br, gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_deleted_comment_refreshes_cached_feed(self):
+        """Удаление комментария сбрасывает кэш главной, как и создание."""
+        cache.clear()
+        url = reverse('posts:first')
+        comment = Comment.objects.create(
+            post=self.post, author=self.user, text='Комментарий')
+        self.assertContains(self.client.get(url), 'Комментариев: 1')
+        comment.delete()
+        self.assertContains(self.client.get(url), 'Комментариев: 0')
+
+    def test_pages_with_cookies_not_cached(self):
+        """В кэш попадают только тело и безопасные заголовки; ответы
+            с cookies или CSRF-токеном не кэшируются."""
+        request = RequestFactory().get('/')
+        response = HttpResponse('Страница', content_type='text/plain')
+        response['X-Frame-Options'] = 'DENY'
+        page = freeze(request, response)
+        self.assertEqual(page['headers'], {'Content-Type': 'text/plain'})
+        response.set_cookie('sessionid', 'secret')
+        self.assertIsNone(freeze(request, response))
+        request.META['CSRF_COOKIE_USED'] = True
+        self.assertIsNone(freeze(request, HttpResponse('Форма')))
+
+    def test_unchanged_post_detail_not_modified(self):
+        """Повторный запрос с ETag или датой получает 304 без вьюхи,
+            после комментария — страницу заново."""
+        url = reverse('posts:post_detail', kwargs={'post_id': self.post.id})
+        response = self.client.get(url)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+        for headers in ({'HTTP_IF_NONE_MATCH': etag},
+                        {'HTTP_IF_MODIFIED_SINCE': last_modified}):
+            with self.subTest(headers=headers):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url, **headers)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(len(queries), 1)
+        Comment.objects.create(
+            post=self.post, author=self.user, text='Комментарий')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_new_csrf_token_changes_etag(self):
+        """Новый CSRF-токен после входа меняет ETag: форма комментария
+            из кэша браузера не уходит со старым токеном."""
+        url = reverse('posts:post_detail', kwargs={'post_id': self.post.id})
+        self.authorized_client.cookies[settings.CSRF_COOKIE_NAME] = 'a' * 64
+        etag = self.authorized_client.get(url)['ETag']
+        self.assertEqual(self.authorized_client.get(
+            url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.authorized_client.cookies[settings.CSRF_COOKIE_NAME] = 'b' * 64
+        self.assertEqual(self.authorized_client.get(
+            url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_deleted_post_changes_feed_etag(self):
+        """Удаление поста меняет ETag главной, хотя кэш ленты остаётся."""
+        url = reverse('posts:first')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Post.objects.filter(id=self.post.id).delete()
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class SQLiteCacheTest(TestCase):
+    def setUp(self):
+        self.location = os.path.join(tempfile.mkdtemp(), 'cache.sqlite3')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.location))
+
+    def make_cache(self, **options):
+        return SQLiteCache(self.location, {'OPTIONS': options})
+
+    def test_entries_shared_between_instances(self):
+        """Запись и сдвиг версии видны другому экземпляру (воркеру)."""
+        first, second = self.make_cache(), self.make_cache()
+        first.set_many({'page': 'html', 'version': 1})
+        self.assertEqual(second.incr('version'), 2)
+        self.assertEqual(
+            first.get_many(['page', 'version', 'missing']),
+            {'page': 'html', 'version': 2}
+        )
+        second.delete('page')
+        self.assertIsNone(first.get('page'))
+
+    def test_integers_beyond_64_bits_pickled(self):
+        """Числа за пределами INTEGER сохраняются, как любое значение."""
+        cache = self.make_cache()
+        cache.set_many({'big': 2 ** 64, 'small': -2 ** 70, 'counter': 1})
+        self.assertEqual(
+            cache.get_many(['big', 'small', 'counter']),
+            {'big': 2 ** 64, 'small': -2 ** 70, 'counter': 1})
+        self.assertEqual(cache.incr('counter'), 2)
+        self.assertEqual(cache.incr('big'), 2 ** 64 + 1)
+        cache.set('edge', 2 ** 63 - 1)
+        self.assertEqual(cache.incr('edge'), 2 ** 63)
+        self.assertEqual(cache.get('edge'), 2 ** 63)
+
+    def test_least_recently_used_entries_culled(self):
+        """При переполнении вытесняются давно не читавшиеся записи."""
+        cache = self.make_cache(MAX_ENTRIES=3, CULL_FREQUENCY=3)
+        for key in ('a', 'b', 'c'):
+            cache.set(key, key)
+        cache._connection.execute(
+            'UPDATE cache SET accessed = accessed - 10 WHERE key != ?',
+            (cache.make_key('a'),))
+        cache.set('d', 'd')
+        self.assertEqual(
+            sorted(cache.get_many(['a', 'b', 'c', 'd'])), ['a', 'c', 'd'])
+
+    def test_size_checked_once_per_share_of_writes(self):
+        """COUNT(*) выполняется раз в MAX_ENTRIES / 100 записей."""
+        cache = self.make_cache(MAX_ENTRIES=1000)
+        statements = []
+        cache._connection.set_trace_callback(statements.append)
+        for i in range(19):
+            cache.set(f'key{i}', i)
+        self.assertEqual(
+            sum('COUNT(*)' in statement for statement in statements), 1)
+
+    def test_many_keys_split_below_variable_limit(self):
+        """get_many и delete_many принимают больше ключей, чем
+            параметров в одном запросе SQLite."""
+        cache = self.make_cache(MAX_ENTRIES=10000)
+        cache._connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        data = {f'key{i}': i for i in range(2500)}
+        cache.set_many(data)
+        self.assertEqual(cache.get_many(list(data)), data)
+        self.assertTrue(cache.delete_many(list(data)))
+        self.assertEqual(cache.get_many(list(data)), {})
+
+
+@override_settings(CACHES=TEST_CACHES)
+class StampedeProtectionTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_waiting_request_gets_stale_copy(self):
+        """Пока один запрос пересчитывает запись, другие получают
+            устаревшую копию и не запускают пересчёт."""
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(
+            get_or_recompute('key:v1', compute, 20, stale_key='key'), 1)
+        cache.add('lock:key:v2', 1)
+        self.assertEqual(
+            get_or_recompute('key:v2', compute, 20, stale_key='key'), 1)
+        self.assertEqual(len(calls), 1)
+        cache.delete('lock:key:v2')
+        self.assertEqual(
+            get_or_recompute('key:v2', compute, 20, stale_key='key'), 2)
+
+    def test_fresh_entry_not_recomputed(self):
+        """Свежая запись отдаётся без пересчёта при beta=0."""
+        get_or_recompute('fresh', lambda: 'value', 20)
+        self.assertEqual(
+            get_or_recompute('fresh', self.fail, 20, beta=0), 'value')
+
+    def test_invalidate_keeps_version_monotonic(self):
+        """Версия растёт до текущего времени, но не уходит в будущее
+            при одновременных сдвигах и не убывает."""
+        key = version_key('race')
+        cache.set(key, int(time.time() * 1000) - 100000, None)
+        threads = [
+            threading.Thread(target=invalidate, args=('race',))
+            for _ in range(8)
+        ]
+        read = SQLiteCache.get
+
+        def slow_get(*args, **kwargs):
+            value = read(*args, **kwargs)
+            time.sleep(0.02)
+            return value
+
+        with mock.patch.object(SQLiteCache, 'get', slow_get):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertLessEqual(
+            cache.get(key), int(time.time() * 1000) + len(threads))
+        future = int(time.time() * 1000) + 100000
+        cache.set(key, future, None)
+        invalidate('race')
+        self.assertEqual(cache.get(key), future + 1)
+
+    @mock.patch('posts.caching.METRICS_FLUSH_INTERVAL', 3600)
+    def test_outcomes_counted_in_process(self):
+        """Попадания считаются в памяти и уходят в кэш одним сбросом."""
+        get_or_recompute('counted', lambda: 'value', 20)
+        with mock.patch('posts.caching.cache.incr', side_effect=self.fail):
+            for _ in range(5):
+                get_or_recompute('counted', self.fail, 20, beta=0,
+                                 metric='counted')
+        self.assertIsNone(cache.get('feed_metrics:counted:fresh'))
+        self.assertEqual(feed_metrics('counted')['fresh'], 5)
+
+    def test_expired_entry_served_while_refreshing(self):
+        """Истёкшая запись отдаётся сразу, пересчёт уходит в фон."""
+        cache.set('swr', ('old', time.time() - 1, 0))
+        with mock.patch('posts.caching.refresh_in_background') as refresh:
+            value = get_or_recompute(
+                'swr', self.fail, 20, stale_for=60, metric='test')
+        self.assertEqual(value, 'old')
+        refresh.assert_called_once()
+        self.assertEqual(feed_metrics('test')['stale'], 1)
+
+    def test_too_stale_entry_recomputed(self):
+        """Запись старше допустимой устаревшести пересчитывается сразу."""
+        cache.set('swr', ('old', time.time() - 100, 0))
+        self.assertEqual(
+            get_or_recompute('swr', lambda: 'new', 20, stale_for=60), 'new')
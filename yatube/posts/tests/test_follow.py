@@ -1,9 +1,13 @@
-from django.test import TestCase, Client
-from django.urls import reverse
+from django.core.cache import cache
+from django.test import TestCase, Client, override_settings
+from django.urls import resolve, reverse
 
+from core.query_budget import budget_of, count_queries, repeated
 from posts.models import Group, Post, User, Follow
+from posts.tests import TEST_CACHES
 
 
+@override_settings(CACHES=TEST_CACHES)
 class FollowTest(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -72,3 +76,67 @@ class FollowTest(TestCase):
         response = self.authorized_client1.get(reverse('posts:follow_index'))
         post_list = response.context['page_obj']
         self.assertNotIn(self.post, post_list)
+
+    def test_timeline_backfill_and_cleanup(self):
+        """Подписка добавляет старые посты автора в ленту,
+            отписка — убирает их, новый пост раскладывается по лентам."""
+        self.authorized_client1.post(reverse(
+            'posts:profile_follow', kwargs={'username': self.user.username}))
+        self.assertTrue(self.user1.timeline.filter(post=self.post).exists())
+        new_post = Post.objects.create(author=self.user, text='Новый пост')
+        self.assertTrue(self.user1.timeline.filter(post=new_post).exists())
+        self.assertFalse(self.user2.timeline.filter(post=new_post).exists())
+        self.authorized_client1.post(reverse(
+            'posts:profile_unfollow', kwargs={
+                'username': self.user.username}))
+        self.assertFalse(self.user1.timeline.exists())
+
+    @override_settings(TIMELINE_PULL_THRESHOLD=2)
+    def test_pull_author_posts_merged_on_read(self):
+        """Посты автора с большим числом подписчиков не раскладываются
+            по лентам, а подмешиваются при чтении."""
+        cache.clear()
+        Follow.objects.create(author=self.user1, user=self.user2)
+        Follow.objects.create(author=self.user, user=self.user1)
+        Follow.objects.create(author=self.user, user=self.user2)
+        pushed = Post.objects.create(author=self.user1, text='Для ленты')
+        pulled = Post.objects.create(author=self.user, text='Подмешан')
+        self.assertFalse(self.user2.timeline.filter(post=pulled).exists())
+        response = self.authorized_client2.get(reverse('posts:follow_index'))
+        self.assertEqual(
+            list(response.context['page_obj']),
+            [pulled, pushed, self.post]
+        )
+
+    @override_settings(TIMELINE_PULL_THRESHOLD=2)
+    def test_posts_kept_when_author_drops_below_threshold(self):
+        """Посты, опубликованные при подмешивании, остаются в ленте,
+            когда автор опускается ниже порога."""
+        cache.clear()
+        Follow.objects.create(author=self.user, user=self.user1)
+        Follow.objects.create(author=self.user, user=self.user2)
+        pulled = Post.objects.create(author=self.user, text='Подмешан')
+        url = reverse('posts:follow_index')
+        self.assertIn(
+            pulled, self.authorized_client2.get(url).context['page_obj'])
+        self.authorized_client1.post(reverse(
+            'posts:profile_unfollow', kwargs={
+                'username': self.user.username}))
+        self.assertTrue(self.user2.timeline.filter(post=pulled).exists())
+        self.assertIn(
+            pulled, self.authorized_client2.get(url).context['page_obj'])
+
+    @override_settings(TIMELINE_PULL_THRESHOLD=1)
+    def test_pull_authors_read_in_one_query(self):
+        """Число запросов ленты не растёт с числом авторов,
+            чьи посты подмешиваются при чтении."""
+        url = reverse('posts:follow_index')
+        for i in range(8):
+            author = User.objects.create_user(username=f'pull{i}')
+            Follow.objects.create(author=author, user=self.user2)
+            Post.objects.create(author=author, text=f'Пост {i}')
+        with count_queries() as queries:
+            response = self.authorized_client2.get(url)
+        self.assertEqual(len(response.context['page_obj']), 8)
+        self.assertLessEqual(
+            len(queries), budget_of(resolve(url).func), repeated(queries))
@@ -1,19 +1,28 @@
+import hashlib
+import os
 import shutil
 import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
 
 from django.test import Client, TestCase, override_settings
 from django.urls import reverse
 from django.shortcuts import get_object_or_404
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.conf import settings
+from django.core.management import call_command
+from PIL import Image
 
 from posts.forms import PostForm
-from posts.models import Post, Group, User, Comment
+from posts.images import EXIF_ORIENTATION, acquire, release, remove_file
+from posts.models import Post, Group, User, Comment, StoredImage
+from posts.storage import addressed_name, image_storage
+from posts.tests import TEST_CACHES
 
 TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
 
 
-@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, CACHES=TEST_CACHES)
 class PostFormTests(TestCase):
     @classmethod
     def tearDownClass(cls):
@@ -52,6 +61,8 @@ class PostFormTests(TestCase):
             author=cls.user,
         )
         cls.form = PostForm()
+        cls.image_name = addressed_name(
+            'posts', hashlib.sha256(cls.small_gif).hexdigest(), '.gif')
 
     def setUp(self):
         self.authorized_client = Client()
@@ -81,7 +92,7 @@ class PostFormTests(TestCase):
         field_verboses = {
             post1.text: form_data['text'],
             post1.group.id: form_data['group'],
-            post1.image.name: f"posts/{form_data['image'].name}"
+            post1.image.name: self.image_name
         }
         for field, expected_value in field_verboses.items():
             with self.subTest(field=field):
@@ -113,13 +124,137 @@ class PostFormTests(TestCase):
         field_verboses = {
             post.text: form_data['text'],
             post.group.id: form_data['group'],
-            post.image.name: f"posts/{form_data['image'].name}"
+            post.image.name: self.image_name
         }
         for field, expected_value in field_verboses.items():
             with self.subTest(field=field):
                 self.assertEqual(field, expected_value)
         self.assertEqual(post.author, self.post.author)
 
+    def test_identical_uploads_stored_once(self):
+        """Одинаковые картинки хранятся одним файлом, ссылки на него
+            считаются до последнего поста."""
+        posts = [
+            Post.objects.create(
+                text=f'Пост {name}', author=self.user,
+                image=SimpleUploadedFile(name, self.small_gif, 'image/gif'))
+            for name in ('first.gif', 'second.GIF')
+        ]
+        self.assertEqual(posts[0].image.name, posts[1].image.name)
+        self.assertEqual(
+            StoredImage.objects.get(name=self.image_name).refs, 2)
+        path = image_storage.path(self.image_name)
+        posts[0].delete()
+        self.assertTrue(os.path.exists(path))
+        posts[1].delete()
+        self.assertFalse(StoredImage.objects.filter(
+            name=self.image_name).exists())
+
+    def test_reacquired_file_not_removed(self):
+        """Файл, на который снова сослались до удаления, остаётся."""
+        name = image_storage.save(
+            'posts/again.gif', SimpleUploadedFile('again.gif', self.small_gif))
+        acquire(name)
+        release(name)
+        acquire(name)
+        remove_file(name)
+        self.assertTrue(image_storage.exists(name))
+
+    def test_simultaneous_uploads_share_name(self):
+        """Загрузка, опоздавшая к уже записанному файлу, получает то же
+            имя по хэшу, без суффикса."""
+        name = image_storage.save(
+            'posts/first.gif', SimpleUploadedFile('first.gif', self.small_gif))
+        for missed in ([False], [False, False]):
+            with self.subTest(missed=len(missed)):
+                exists = iter(missed)
+                with mock.patch.object(
+                        image_storage, 'exists',
+                        lambda name: next(exists, True)):
+                    self.assertEqual(image_storage.save(
+                        'posts/late.gif',
+                        SimpleUploadedFile('late.gif', self.small_gif)), name)
+
+    def test_dedupe_images(self):
+        """dedupe_images переводит старые копии на один файл по хэшу."""
+        legacy = ['posts/meme.gif', 'posts/meme_copy.gif']
+        for name in legacy:
+            os.makedirs(os.path.dirname(image_storage.path(name)),
+                        exist_ok=True)
+            with open(image_storage.path(name), 'wb') as file:
+                file.write(self.small_gif)
+        posts = [
+            Post.objects.create(text='Старый пост', author=self.user,
+                                image=name)
+            for name in legacy
+        ]
+        call_command('dedupe_images', processes=1, stdout=StringIO())
+        for post in posts:
+            post.refresh_from_db()
+            self.assertEqual(post.image.name, self.image_name)
+        self.assertTrue(os.path.exists(image_storage.path(self.image_name)))
+        self.assertEqual(
+            StoredImage.objects.get(name=self.image_name).refs, 2)
+        self.assertFalse(StoredImage.objects.filter(
+            name__in=legacy).exists())
+
+    @staticmethod
+    def photo(size, orientation=1):
+        image = Image.new('RGB', size, 'red')
+        exif = Image.Exif()
+        exif[EXIF_ORIENTATION] = orientation
+        content = BytesIO()
+        image.save(content, 'JPEG', exif=exif)
+        return SimpleUploadedFile(
+            'photo.jpg', content.getvalue(), 'image/jpeg')
+
+    @mock.patch('posts.images.MAX_MASTER_SIDE', 64)
+    def test_upload_downscaled_and_oriented(self):
+        """Большое фото сохраняется уменьшенным и повёрнутым по EXIF."""
+        form = PostForm(data={'text': 'Фото'},
+                        files={'image': self.photo((200, 100), orientation=6)})
+        self.assertTrue(form.is_valid(), form.errors)
+        form.instance.author = self.user
+        post = form.save()
+        with Image.open(post.image.path) as master:
+            self.assertEqual(master.size, (32, 64))
+            self.assertNotIn(EXIF_ORIENTATION, master.getexif())
+
+    @mock.patch('posts.images.MAX_MASTER_SIDE', 64)
+    def test_mpo_photo_saved_as_jpeg(self):
+        """Фото в MPO пересохраняется основным кадром в JPEG."""
+        content = BytesIO()
+        Image.new('RGB', (200, 100), 'red').save(
+            content, 'MPO', save_all=True,
+            append_images=[Image.new('RGB', (200, 100), 'blue')])
+        form = PostForm(data={'text': 'Фото'}, files={
+            'image': SimpleUploadedFile(
+                'photo.jpg', content.getvalue(), 'image/jpeg')})
+        self.assertTrue(form.is_valid(), form.errors)
+        form.instance.author = self.user
+        post = form.save()
+        with Image.open(post.image.path) as master:
+            self.assertEqual((master.format, master.size), ('JPEG', (64, 32)))
+
+    @mock.patch('posts.images.MAX_MASTER_SIDE', 64)
+    def test_unsaveable_image_rejected(self):
+        """Ошибка кодировщика при пересохранении — ошибка формы, не 500."""
+        photo = self.photo((200, 100))
+        with mock.patch.object(Image.Image, 'save', side_effect=KeyError):
+            form = PostForm(data={'text': 'Фото'}, files={'image': photo})
+            self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors.as_data()['image'][0].code,
+                         'invalid_image')
+
+    @mock.patch('posts.images.MAX_UPLOAD_PIXELS', 100)
+    def test_upload_pixel_limit(self):
+        """Картинка больше лимита пикселей отклоняется до декодирования."""
+        form = PostForm(data={'text': 'Фото'},
+                        files={'image': self.photo((20, 20))})
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors.as_data()['image'][0].code,
+                         'too_many_pixels')
+
     def test_create_comment(self):
         """Валидная форма создает комментарий к посту."""
         comment_list = list(Comment.objects.values_list('id', flat=True))
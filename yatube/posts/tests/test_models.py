@@ -1,8 +1,17 @@
-from django.test import TestCase
+from io import StringIO
 
-from posts.models import Group, Post, User, MAX_LEN
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 
+from core.query_budget import count_queries
+from posts.models import (
+    Comment, Follow, Group, Post, User, UserStats, MAX_LEN
+)
+from posts.stats import stats_for
+from posts.tests import TEST_CACHES
 
+
+@override_settings(CACHES=TEST_CACHES)
 class PostModelTest(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -45,3 +54,57 @@ class PostModelTest(TestCase):
 
         self.assertEqual(self.post._meta.get_field(
             'group').help_text, 'Группа, к которой будет относиться пост')
+
+    def test_comment_count_follows_comments(self):
+        """Счётчик комментариев меняется вместе с комментариями,
+            recount_comments исправляет расхождение."""
+        comment = Comment.objects.create(
+            post=self.post, author=self.user, text='Комментарий')
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 1)
+        comment.delete()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 0)
+        Post.objects.filter(id=self.post.id).update(comment_count=5)
+        call_command('recount_comments', stdout=StringIO())
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 0)
+
+    def test_post_delete_skips_comment_count_updates(self):
+        """Каскад комментариев удаляемого поста не обновляет его счётчик."""
+        post = Post.objects.create(author=self.user, text='Удаляемый пост')
+        Comment.objects.bulk_create(
+            Comment(post=post, author=self.user, text=f'Комментарий {i}')
+            for i in range(5))
+        with count_queries() as queries:
+            post.delete()
+        self.assertFalse([
+            sql for sql in queries
+            if sql.startswith('UPDATE "posts_post"')])
+
+    def test_user_stats_follow_posts_and_follows(self):
+        """Счётчики профиля меняются вместе с постами и подписками,
+            recount_stats исправляет расхождение."""
+        follower = User.objects.create_user(username='follower')
+        stats = stats_for(self.user.id)
+        self.assertEqual(stats.posts_count, 1)
+        Post.objects.create(author=self.user, text='Второй пост')
+        follow = Follow.objects.create(author=self.user, user=follower)
+        stats.refresh_from_db()
+        self.assertEqual(
+            (stats.posts_count, stats.followers_count), (2, 1))
+        self.assertEqual(stats_for(follower.id).following_count, 1)
+        follow.delete()
+        stats.refresh_from_db()
+        self.assertEqual(stats.followers_count, 0)
+        UserStats.objects.filter(user=self.user).update(posts_count=7)
+        call_command('recount_stats', stdout=StringIO())
+        stats.refresh_from_db()
+        self.assertEqual(stats.posts_count, 2)
+
+    def test_new_user_counters_never_dropped(self):
+        """Счётчики заводятся с пользователем: первый сдвиг не теряется."""
+        author = User.objects.create_user(username='new_author')
+        Post.objects.create(author=author, text='Первый пост')
+        self.assertEqual(
+            UserStats.objects.get(user=author).posts_count, 1)
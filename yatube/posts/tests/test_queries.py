@@ -0,0 +1,88 @@
+from django.core.cache import cache
+from django.test import Client, TestCase, override_settings
+from django.urls import resolve, reverse
+
+from core.query_budget import budget_of, count_queries, repeated
+from posts.models import Comment, Follow, Group, Post, User
+from posts.stats import reconcile
+from posts.tests import TEST_CACHES
+
+DATASET_SIZES = (1, 5, 15)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class QueryBudgetTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.author = User.objects.create_user(username='Автор')
+        cls.reader = User.objects.create_user(username='Читатель')
+        cls.group = Group.objects.create(
+            title='Тестовая группа',
+            slug='test_slug',
+            description='Тестовое описание',
+        )
+        Follow.objects.create(author=cls.author, user=cls.reader)
+
+    def setUp(self):
+        self.client = Client()
+        self.client.force_login(self.reader)
+
+    def add_posts(self, count):
+        for i in range(count):
+            post = Post.objects.create(
+                text=f'Тестовый текст_{i}',
+                group=self.group,
+                author=self.author,
+                image=f'posts/picture_{i}.gif',
+            )
+            Comment.objects.create(
+                post=post, author=self.reader, text='Комментарий')
+        reconcile()
+        return post
+
+    def viewers(self):
+        '''Аноним, автор, подписчик и посторонний пользователь.'''
+        other = User.objects.get_or_create(username='Посторонний')[0]
+        for name, user in (('anonymous', None), ('author', self.author),
+                           ('follower', self.reader), ('other', other)):
+            client = Client()
+            if user is not None:
+                client.force_login(user)
+            yield name, client
+
+    def test_views_stay_within_budget(self):
+        """Число запросов вьюх не превышает бюджет при любом объёме данных
+            и для любого зрителя."""
+        for size in DATASET_SIZES:
+            post = self.add_posts(size)
+            urls = (
+                reverse('posts:first'),
+                reverse('posts:group_list', kwargs={'slug': self.group.slug}),
+                reverse('posts:profile', kwargs={
+                    'username': self.author.username}),
+                reverse('posts:post_detail', kwargs={'post_id': post.id}),
+                reverse('posts:post_comments', kwargs={'post_id': post.id}),
+                reverse('posts:follow_index'),
+            )
+            for viewer, client in self.viewers():
+                for url in urls:
+                    with self.subTest(size=size, viewer=viewer, url=url):
+                        cache.clear()
+                        budget = budget_of(resolve(url).func)
+                        with count_queries() as queries:
+                            client.get(url)
+                        self.assertLessEqual(
+                            len(queries), budget, repeated(queries))
+
+    def test_feed_thumbnails_looked_up_in_one_query(self):
+        """Миниатюры страницы ленты читаются из KVStore одним запросом."""
+        for i in range(3):
+            Post.objects.create(
+                text=f'Пост с картинкой {i}', author=self.author,
+                image=f'posts/picture_{i}.gif')
+        cache.clear()
+        with count_queries() as queries:
+            self.client.get(reverse('posts:first'))
+        self.assertEqual(
+            len([sql for sql in queries if 'thumbnail_kvstore' in sql]), 1)
@@ -1,12 +1,14 @@
 from http import HTTPStatus
 
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
 from django.core.cache import cache
 
 from posts.models import Post, Group, User
+from posts.tests import TEST_CACHES
 
 
+@override_settings(CACHES=TEST_CACHES)
 class PostURLTests(TestCase):
     @classmethod
     def setUpClass(cls):
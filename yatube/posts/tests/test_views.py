@@ -1,22 +1,35 @@
+import json
+import os
 import shutil
 import tempfile
+from io import StringIO
+from unittest import mock
 
+from django.core.management import call_command
 from django.test import Client, TestCase, override_settings
 from django.urls import reverse
+from django.utils.http import urlsafe_base64_encode
 from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.conf import settings
+from django.template import engines
 
-from posts.models import Post, Group, User
+from posts.models import Comment, Post, Group, User
 from posts.forms import PostForm, CommentForm
+from posts.thumbnails import THUMBNAIL_SIZES, THUMBNAIL_WIDTHS, generate
+from posts.tests import TEST_CACHES
+from core.query_budget import count_queries
+from core.template_warmup import warm_up_templates
+from posts.utils import page_window
 from posts.constants import (
-    VIEW_LIST_COUNT_OF_PAGINATOR as VIEW_LIST, POSTS_COUNT_FOR_TEST as POSTS
+    VIEW_LIST_COUNT_OF_PAGINATOR as VIEW_LIST, POSTS_COUNT_FOR_TEST as POSTS,
+    COMMENTS_PER_PAGE
 )
 
 TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
 
 
-@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, CACHES=TEST_CACHES)
 class PostPagesTests(TestCase):
     @classmethod
     def tearDownClass(cls):
@@ -125,6 +138,27 @@ class PostPagesTests(TestCase):
         self.context_testing(post, self)
         self.assertIsInstance(response.context.get('form'), CommentForm)
 
+    def test_thumbnail_generated_outside_request(self):
+        '''Пока миниатюр нет, страница выводит заглушку и ставит их
+            в очередь; после создания в фоне — <picture> со srcset.'''
+        url = reverse('posts:post_detail', kwargs={'post_id': self.post.id})
+        with mock.patch('posts.thumbnails.queue_thumbnail') as queue:
+            response = self.client.get(url)
+        self.assertNotContains(response, '<img class="card-img')
+        queue.assert_called_with(self.post.image.name, THUMBNAIL_SIZES)
+        profile = reverse('posts:profile', kwargs={'username': self.user})
+        etag = self.client.get(profile)['ETag']
+        generate(self.post.image.name)
+        self.assertEqual(self.client.get(
+            profile, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        response = self.client.get(url)
+        self.assertContains(response, '<img class="card-img')
+        self.assertContains(response, '<source type="image/webp"')
+        for width in THUMBNAIL_WIDTHS:
+            with self.subTest(width=width):
+                self.assertContains(response, f'.webp {width}w')
+                self.assertContains(response, f'.jpg {width}w')
+
     def test_create_post_correct_context(self):
         """Шаблон create_post сформирован с правильным контекстом."""
         response = self.authorized_client.get(reverse('posts:post_create'))
@@ -179,6 +213,7 @@ class PostPagesTests(TestCase):
         self.assertIsInstance(response.context.get('is_edit'), bool)
 
 
+@override_settings(CACHES=TEST_CACHES)
 class PaginatorViewsTest(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -196,6 +231,9 @@ class PaginatorViewsTest(TestCase):
                 author=cls.user,
             )
 
+    def setUp(self):
+        cache.clear()
+
     def test_first_page_index_contains_ten_records(self):
         '''Количество постов на первой странице равно 10.'''
         field_verboses = {
@@ -224,7 +262,200 @@ class PaginatorViewsTest(TestCase):
                 response = self.client.get(value + '?page=2')
                 self.assertEqual(len(response.context['page_obj']), expected)
 
+    def test_page_past_end_shows_last_page(self):
+        '''Номер за концом ленты открывает последнюю страницу.'''
+        urls = (
+            reverse('posts:first'),
+            reverse('posts:group_list', kwargs={'slug': self.group.slug}),
+            reverse('posts:profile', kwargs={'username': self.user}),
+        )
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.client.get(url + '?page=999')
+                self.assertEqual(response.status_code, 200)
+                page_obj = response.context['page_obj']
+                self.assertEqual(page_obj.number, 2)
+                self.assertEqual(len(page_obj), POSTS - VIEW_LIST)
+
+    @mock.patch('posts.utils.COUNT_ESTIMATE_FROM', 5)
+    def test_estimated_feed_clamps_page_without_count(self):
+        '''Дыра в id завышает оценку: номер за концом ленты отдаёт
+            последние посты без полного COUNT(*).'''
+        Post.objects.create(id=1000, text='Дальний id', author=self.user)
+        with count_queries() as queries:
+            response = self.client.get(reverse('posts:first'), {'page': 50})
+        page_obj = response.context['page_obj']
+        self.assertEqual(len(page_obj), VIEW_LIST)
+        self.assertFalse(page_obj.has_next())
+        self.assertEqual(
+            page_obj[-1], Post.objects.order_by('pub_date', 'id').first())
+        self.assertFalse([
+            sql for sql in queries if 'COUNT(' in sql and 'LIMIT' not in sql])
+
+    def test_cursor_with_huge_id_falls_back_to_pages(self):
+        '''Курсор с id за пределами BIGINT не роняет страницу.'''
+        token = urlsafe_base64_encode(
+            f'{self.post.pub_date.isoformat()}|{10 ** 30}'.encode())
+        response = self.client.get(reverse('posts:first'), {'after': token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['page_obj'].number, 1)
+
     def test_unexisting_page_to_castom_page(self):
         """Cтраница 404 отдаёт кастомный шаблон."""
         response = self.client.get('/unexisting_page/')
         self.assertTemplateUsed(response, 'core/404.html')
+
+    def test_keyset_pages_follow_cursor(self):
+        '''Переход по ?after= и ?before= отдаёт соседние страницы.'''
+        url = reverse('posts:group_list', kwargs={'slug': self.group.slug})
+        first_page = self.client.get(url).context['page_obj']
+        response = self.client.get(
+            url, {'after': first_page.next_cursor})
+        second_page = response.context['page_obj']
+        self.assertEqual(len(second_page), POSTS - VIEW_LIST)
+        self.assertEqual(
+            list(second_page),
+            list(self.client.get(url + '?page=2').context['page_obj'])
+        )
+        self.assertFalse(second_page.has_next())
+        response = self.client.get(
+            url, {'before': second_page.previous_cursor})
+        self.assertEqual(
+            list(response.context['page_obj']), list(first_page))
+        self.assertFalse(response.context['page_obj'].has_previous())
+
+    def test_comments_paginated_by_cursor(self):
+        '''Комментарии отдаются страницами, следующая — фрагментом.'''
+        Comment.objects.bulk_create(
+            Comment(post=self.post, author=self.user, text=f'Комментарий {i}')
+            for i in range(COMMENTS_PER_PAGE + 5)
+        )
+        response = self.client.get(
+            reverse('posts:post_detail', kwargs={'post_id': self.post.id}))
+        comments = response.context['comments']
+        self.assertEqual(len(comments), COMMENTS_PER_PAGE)
+        self.assertTrue(comments.has_next())
+        url = reverse('posts:post_comments', kwargs={'post_id': self.post.id})
+        with self.assertNumQueries(2):
+            response = self.client.get(url, {'after': comments.next_cursor})
+        self.assertTemplateUsed(response, 'posts/includes/comments.html')
+        self.assertEqual(len(response.context['comments']), 5)
+        self.assertNotContains(response, 'Показать ещё')
+
+    def test_page_window_is_bounded(self):
+        '''Окно страниц не зависит от общего количества страниц.'''
+        self.assertEqual(
+            list(page_window(25000, 50000)),
+            [1, None, 24998, 24999, 25000, 25001, 25002, None, 50000]
+        )
+        self.assertEqual(list(page_window(2, 3)), [1, 2, 3])
+        response = self.client.get(reverse('posts:first'))
+        self.assertEqual(response.context['page_obj'].page_window, [1, 2])
+
+    @mock.patch('posts.utils.MAX_NUMBERED_PAGES', 1)
+    def test_cursor_mode_renders_no_page_numbers(self):
+        '''В режиме курсоров нет ссылок ?page= на глубокие страницы.'''
+        response = self.client.get(reverse('posts:first'))
+        self.assertTrue(response.context['page_obj'].use_cursors)
+        self.assertContains(response, '?after=')
+        self.assertNotContains(response, '?page=')
+
+    @override_settings(TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'DIRS': settings.TEMPLATES[0]['DIRS'],
+        'OPTIONS': {'loaders': [(
+            'django.template.loaders.cached.Loader',
+            settings.TEMPLATE_LOADERS,
+        )]},
+    }])
+    def test_templates_warmed_up(self):
+        '''Прогрев кладёт все шаблоны в кэш cached.Loader.'''
+        self.assertGreater(warm_up_templates(), 0)
+        loader, = engines['django'].engine.template_loaders
+        self.assertIn(
+            'posts/includes/post_list.html', loader.get_template_cache)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SnapshotExportTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user = User.objects.create_user(username='Автор')
+        cls.post = Post.objects.create(text='Тестовый текст', author=cls.user)
+
+    def setUp(self):
+        cache.clear()
+        self.output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output, ignore_errors=True)
+
+    def export(self):
+        call_command(
+            'export_snapshots', output=self.output, processes=1,
+            stdout=StringIO())
+        with open(os.path.join(self.output, 'manifest.json')) as file:
+            return json.load(file)
+
+    def test_snapshots_rewritten_only_when_changed(self):
+        '''Снимки анонимных страниц перезаписываются только при изменении,
+            удалённые страницы убираются.'''
+        url = reverse('posts:post_detail', kwargs={'post_id': self.post.id})
+        manifest = self.export()
+        path = os.path.join(self.output, manifest[url]['path'])
+        with open(path) as file:
+            self.assertIn('Тестовый текст', file.read())
+        self.assertIn(reverse('about:author'), manifest)
+        self.assertEqual(self.export()[url], manifest[url])
+        self.post.text = 'Отредактированный текст'
+        self.post.save()
+        self.assertNotEqual(
+            self.export()[url]['sha256'], manifest[url]['sha256'])
+        self.post.delete()
+        self.assertNotIn(url, self.export())
+        self.assertFalse(os.path.exists(path))
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, CACHES=TEST_CACHES)
+class MediaServingTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        os.makedirs(os.path.join(TEMP_MEDIA_ROOT, 'posts'), exist_ok=True)
+        with open(os.path.join(TEMP_MEDIA_ROOT, 'posts', 'x.gif'), 'wb') as f:
+            f.write(b'0123456789')
+        self.url = reverse('media', kwargs={'path': 'posts/x.gif'})
+
+    def test_range_and_conditional_get(self):
+        '''Медиа отдаётся диапазонами и с условным GET.'''
+        response = self.client.get(self.url)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Content-Type'], 'image/gif')
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+        self.assertEqual(b''.join(response.streaming_content), b'234')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-3')
+        self.assertEqual(b''.join(response.streaming_content), b'789')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=20-')
+        self.assertEqual(response.status_code, 416)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(
+            self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(
+            reverse('media', kwargs={'path': '../settings.py'}))
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(MEDIA_SENDFILE='x-accel-redirect')
+    def test_accel_redirect(self):
+        '''С nginx тело не читается, отдаётся X-Accel-Redirect.'''
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response['X-Accel-Redirect'], '/protected-media/posts/x.gif')
+        self.assertEqual(response.content, b'')
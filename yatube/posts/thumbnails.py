@@ -0,0 +1,268 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models.functions import Now
+from sorl.thumbnail import default
+from sorl.thumbnail.base import ThumbnailBackend
+from sorl.thumbnail.conf import defaults as default_settings
+from sorl.thumbnail.conf import settings as thumbnail_settings
+from sorl.thumbnail.images import (
+    DummyImageFile, ImageFile, deserialize_image_file
+)
+from sorl.thumbnail.kvstores.base import add_prefix
+from sorl.thumbnail.kvstores.cached_db_kvstore import EMPTY_VALUE
+from sorl.thumbnail.kvstores.cached_db_kvstore import KVStore as CachedDBStore
+from sorl.thumbnail.models import KVStore as KVStoreModel
+
+from .caching import forget_posts, invalidate, post_feeds
+from .models import Post
+from .storage import image_storage
+
+logger = logging.getLogger('posts.thumbnails')
+
+# Производные картинки поста: ширины для srcset в WebP и JPEG,
+# кадрированные под пропорции карточки 960x339.
+THUMBNAIL_WIDTHS = (320, 640, 960)
+THUMBNAIL_FORMATS = ('WEBP', 'JPEG')
+THUMBNAIL_ASPECT = (960, 339)
+MIME_TYPES = {'WEBP': 'image/webp', 'JPEG': 'image/jpeg'}
+
+
+def thumbnail_geometry(width):
+    aspect_width, aspect_height = THUMBNAIL_ASPECT
+    return f'{width}x{round(width * aspect_height / aspect_width)}'
+
+
+THUMBNAIL_SIZES = tuple(
+    (thumbnail_geometry(width),
+     {'crop': 'center', 'upscale': True, 'format': format_})
+    for format_ in THUMBNAIL_FORMATS
+    for width in THUMBNAIL_WIDTHS
+)
+
+_executor = None
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def thumbnail_executor():
+    '''Общий пул потоков, в котором создаются миниатюры.'''
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.THUMBNAIL_WORKERS,
+            thread_name_prefix='thumbnails')
+    return _executor
+
+
+def pending_key(name, sizes):
+    return name, repr([(geometry, sorted(options.items()))
+                       for geometry, options in sizes])
+
+
+def generate(name, sizes=THUMBNAIL_SIZES):
+    '''Создаёт миниатюры и записи о них в KVStore, как sorl при рендере,
+    декодируя исходник один раз на все размеры.
+
+    Затем сдвигает updated у постов с этой картинкой одним UPDATE без
+    сигналов: меняется ключ карточки. Версии лент, где видны посты,
+    сдвигаются, чтобы сменились ETag страниц с заглушкой; состав лент
+    не менялся, поэтому списки id и количества остаются в кэше.
+    '''
+    try:
+        default.backend.generate_many(ImageFile(name, image_storage), sizes)
+        posts = list(Post.objects.filter(image=name).only(
+            'id', 'author_id', 'group_id'))
+        if posts:
+            post_ids = [post.id for post in posts]
+            Post.objects.filter(id__in=post_ids).update(updated=Now())
+            forget_posts(*post_ids)
+            invalidate(*(feed for post in posts for feed in post_feeds(post)))
+    except Exception:
+        logger.exception('Миниатюры %s не созданы', name)
+    finally:
+        with _pending_lock:
+            _pending.discard(pending_key(name, sizes))
+        connections.close_all()
+
+
+def queue_thumbnail(name, sizes=THUMBNAIL_SIZES):
+    '''Ставит миниатюры картинки в очередь после фиксации транзакции,
+    одни и те же — не больше одного раза одновременно.'''
+    sizes = tuple((geometry, dict(options)) for geometry, options in sizes)
+    key = pending_key(name, sizes)
+
+    def submit():
+        with _pending_lock:
+            if key in _pending:
+                return
+            _pending.add(key)
+        thumbnail_executor().submit(generate, name, sizes)
+
+    transaction.on_commit(submit)
+
+
+def queue_thumbnails(image):
+    '''Все размеры из шаблонов для только что загруженной картинки.'''
+    if image:
+        queue_thumbnail(image.name)
+
+
+def get_many_thumbnails(thumbnails):
+    '''Записи KVStore для нескольких миниатюр: {key: ImageFile или None}.
+
+    Для cached_db одним get_many из кэша sorl и одним запросом к таблице
+    для промахов; отсутствие записи кэшируется, как это делает sorl.
+    '''
+    kvstore = default.kvstore
+    if not isinstance(kvstore, CachedDBStore):
+        return {
+            thumbnail.key: kvstore.get(thumbnail) for thumbnail in thumbnails}
+    raw_keys = {add_prefix(thumbnail.key): thumbnail.key
+                for thumbnail in thumbnails}
+    values = kvstore.cache.get_many(list(raw_keys))
+    missing = [key for key in raw_keys if key not in values]
+    if missing:
+        rows = dict(KVStoreModel.objects.filter(
+            key__in=missing).values_list('key', 'value'))
+        fetched = {key: rows.get(key, EMPTY_VALUE) for key in missing}
+        kvstore.cache.set_many(
+            fetched, thumbnail_settings.THUMBNAIL_CACHE_TIMEOUT)
+        values.update(fetched)
+    return {
+        raw_keys[key]: (
+            None if not value or value == EMPTY_VALUE
+            else deserialize_image_file(value))
+        for key, value in values.items()
+    }
+
+
+def thumbnail_files(image):
+    '''(geometry, options, файл миниатюры) для всех THUMBNAIL_SIZES.'''
+    backend = default.backend
+    source = ImageFile(image)
+    return [
+        (geometry, options,
+         backend.thumbnail_file(source, geometry, dict(options)))
+        for geometry, options in THUMBNAIL_SIZES
+    ]
+
+
+def prefetch_thumbnails(posts):
+    '''Миниатюры всех картинок страницы одним обращением к KVStore.
+
+    Результат лежит на post.image, и тег {% thumbnail %} берёт его оттуда
+    вместо отдельного запроса на каждый пост.
+    '''
+    wanted = []
+    for post in posts:
+        if not post.image:
+            continue
+        post.image.prefetched_thumbnails = {}
+        for _, _, thumbnail in thumbnail_files(post.image):
+            wanted.append((post.image, thumbnail))
+    if not wanted:
+        return
+    found = get_many_thumbnails([thumbnail for _, thumbnail in wanted])
+    for image, thumbnail in wanted:
+        image.prefetched_thumbnails[thumbnail.key] = found.get(thumbnail.key)
+
+
+def responsive_sources(image):
+    '''srcset картинки по форматам и запасной JPEG наибольшей ширины.
+
+    None, пока готовы не все размеры: недостающие уже в очереди,
+    а шаблон выводит заглушку.
+    '''
+    if not image:
+        return None
+    if not hasattr(image, 'prefetched_thumbnails'):
+        prefetch_thumbnails([SimpleNamespace(image=image)])
+    srcsets = {}
+    fallback = None
+    for geometry, options in THUMBNAIL_SIZES:
+        thumbnail = default.backend.get_thumbnail(image, geometry, **options)
+        if isinstance(thumbnail, DummyImageFile):
+            return None
+        format_ = options['format']
+        srcsets.setdefault(format_, []).append(
+            f'{thumbnail.url} {thumbnail.width}w')
+        if format_ == 'JPEG' and (
+                fallback is None or thumbnail.width > fallback.width):
+            fallback = thumbnail
+    return {
+        'sources': [
+            {'type': MIME_TYPES[format_], 'srcset': ', '.join(srcset)}
+            for format_, srcset in srcsets.items()
+        ],
+        'fallback': fallback,
+    }
+
+
+class QueuedThumbnailBackend(ThumbnailBackend):
+    '''Бэкенд sorl, который не обрабатывает картинки во время запроса.
+
+    Готовая миниатюра берётся из prefetch_thumbnails() или из KVStore.
+    Если её ещё нет, создание
+    уходит в пул потоков, а тег {% thumbnail %} получает заглушку
+    и выводит ветку {% empty %}.
+    '''
+
+    def thumbnail_file(self, source, geometry_string, options):
+        '''Файл миниатюры: имя считается так же, как в get_thumbnail().'''
+        if thumbnail_settings.THUMBNAIL_PRESERVE_FORMAT:
+            options.setdefault('format', self._get_format(source))
+        for key, value in self.default_options.items():
+            options.setdefault(key, value)
+        for key, attr in self.extra_options:
+            value = getattr(thumbnail_settings, attr)
+            if value != getattr(default_settings, attr):
+                options.setdefault(key, value)
+        name = self._get_thumbnail_filename(source, geometry_string, options)
+        return ImageFile(name, default.storage)
+
+    def get_thumbnail(self, file_, geometry_string, **options):
+        if not file_:
+            raise ValueError('falsey file_ argument in get_thumbnail()')
+        source = ImageFile(file_)
+        requested = dict(options)
+        thumbnail = self.thumbnail_file(source, geometry_string, options)
+        prefetched = getattr(file_, 'prefetched_thumbnails', {})
+        if thumbnail.key in prefetched:
+            cached = prefetched[thumbnail.key]
+        else:
+            cached = default.kvstore.get(thumbnail)
+        if cached:
+            return cached
+        sizes = THUMBNAIL_SIZES
+        if (geometry_string, requested) not in THUMBNAIL_SIZES:
+            sizes = ((geometry_string, requested),)
+        queue_thumbnail(source.name, sizes)
+        return DummyImageFile(geometry_string)
+
+    def generate_many(self, file_, sizes):
+        '''Недостающие миниатюры из sizes за одно декодирование исходника.'''
+        source = ImageFile(file_)
+        thumbnails = []
+        for geometry_string, options in sizes:
+            options = dict(options)
+            thumbnail = self.thumbnail_file(source, geometry_string, options)
+            if not default.kvstore.get(thumbnail):
+                thumbnails.append((geometry_string, options, thumbnail))
+        if not thumbnails:
+            return
+        source_image = default.engine.get_image(source)
+        try:
+            for geometry_string, options, thumbnail in thumbnails:
+                if not thumbnail.exists():
+                    self._create_thumbnail(
+                        source_image, geometry_string, options, thumbnail)
+        finally:
+            default.engine.cleanup(source_image)
+        default.kvstore.get_or_set(source)
+        for _, _, thumbnail in thumbnails:
+            default.kvstore.set(thumbnail, source)
@@ -0,0 +1,100 @@
+from django.conf import settings
+
+from .models import Follow, Post, TimelineEntry, UserStats
+from .stats import stats_for
+
+
+def follower_counts(author_ids):
+    '''Количество подписчиков авторов из UserStats одним запросом.'''
+    counts = dict(
+        UserStats.objects.filter(user_id__in=author_ids)
+        .values_list('user_id', 'followers_count')
+    )
+    for author_id in author_ids:
+        if author_id not in counts:
+            counts[author_id] = stats_for(author_id).followers_count
+    return counts
+
+
+def is_pull_author(author_id):
+    '''Посты автора с множеством подписчиков не раскладываются по лентам.'''
+    return (follower_counts([author_id])[author_id]
+            >= settings.TIMELINE_PULL_THRESHOLD)
+
+
+def pull_authors(user):
+    '''Авторы из подписок пользователя, чьи посты читаются при показе.
+
+    Один запрос с JOIN на UserStats: запись счётчиков создаётся вместе
+    с пользователем.
+    '''
+    return list(user.follower.filter(
+        author__stats__followers_count__gte=settings.TIMELINE_PULL_THRESHOLD,
+    ).values_list('author_id', flat=True))
+
+
+def fan_out(post):
+    '''Раскладывает новый пост по лентам подписчиков автора.'''
+    if is_pull_author(post.author_id):
+        return
+    followers = Follow.objects.filter(
+        author_id=post.author_id).values_list('user_id', flat=True)
+    TimelineEntry.objects.bulk_create(
+        [
+            TimelineEntry(
+                user_id=user_id,
+                post=post,
+                author_id=post.author_id,
+                pub_date=post.pub_date,
+            )
+            for user_id in followers.iterator()
+        ],
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+
+
+def backfill(follow):
+    '''Добавляет в ленту подписчика уже опубликованные посты автора.'''
+    if is_pull_author(follow.author_id):
+        return
+    copy_posts(follow.user_id, follow.author_id)
+
+
+def copy_posts(user_id, author_id):
+    posts = Post.objects.filter(
+        author_id=author_id).values_list('id', 'pub_date')
+    TimelineEntry.objects.bulk_create(
+        [
+            TimelineEntry(
+                user_id=user_id,
+                post_id=post_id,
+                author_id=author_id,
+                pub_date=pub_date,
+            )
+            for post_id, pub_date in posts.iterator()
+        ],
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+
+
+def demote(author_id):
+    '''Автор опустился ниже порога: посты, опубликованные, пока их
+    подмешивали при чтении, раскладываются по лентам оставшихся
+    подписчиков, иначе они пропали бы из лент. Возвращает id тех,
+    чьи ленты изменились.'''
+    threshold = settings.TIMELINE_PULL_THRESHOLD
+    if follower_counts([author_id])[author_id] != threshold - 1:
+        return []
+    followers = list(Follow.objects.filter(
+        author_id=author_id).values_list('user_id', flat=True))
+    for user_id in followers:
+        copy_posts(user_id, author_id)
+    return followers
+
+
+def remove(follow):
+    '''Убирает посты автора из ленты отписавшегося пользователя.'''
+    TimelineEntry.objects.filter(
+        user_id=follow.user_id, author_id=follow.author_id).delete()
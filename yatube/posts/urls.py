@@ -8,6 +8,9 @@ urlpatterns = [
     path('', views.index, name='first'),
     path('group/<slug:slug>/', views.group_posts, name='group_list'),
     path('posts/<int:post_id>/', views.post_detail, name='post_detail'),
+    path(
+        'posts/<int:post_id>/comments/',
+        views.post_comments, name='post_comments'),
     path('profile/<str:username>/', views.profile, name='profile'),
     path('create/', views.post_create, name='post_create'),
     path('posts/<int:post_id>/edit/', views.post_edit, name='post_edit'),
@@ -1,10 +1,404 @@
-from django.core.paginator import Paginator
+import heapq
+from datetime import datetime
+from hashlib import md5
 
+from django.core.cache import cache
+from django.core.paginator import Paginator, Page, EmptyPage
+from django.db.models import Q, Max, Min
+from django.utils.functional import cached_property
+from django.utils.encoding import force_bytes, force_str
+from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 
-def pager_list(request, page_list, VIEW_LIST):
-    '''Пейджинатор, то есть постраничное разбиение списка постов'''
-    paginator = Paginator(page_list, VIEW_LIST)
+from posts.caching import feed_versions, hydrate_posts, invalidate
+from posts.constants import (
+    MAX_NUMBERED_PAGES, FEED_COUNT_TIMEOUT, COUNT_ESTIMATE_FROM,
+    PAGE_WINDOW_ON_EACH_SIDE, PAGE_WINDOW_ON_ENDS, FEED_IDS_TIMEOUT
+)
+
+
+def feed_count_key(name):
+    '''Ключ кэша с количеством постов ленты: index, group:1, author:1...'''
+    return f'feed_count:{name}'
+
+
+def invalidate_feed_counts(*names):
+    '''Сбрасывает закэшированные количества постов для перечисленных лент.'''
+    cache.delete_many([feed_count_key(name) for name in names])
+
+
+def members_feed(name):
+    '''Версия состава ленты: сдвигается при появлении и удалении постов,
+    но не при их правке.'''
+    return f'{name}:members'
+
+
+def invalidate_feed_members(*names):
+    '''Состав лент изменился: сбрасывает количества и списки id страниц.'''
+    invalidate_feed_counts(*names)
+    invalidate(*(members_feed(name) for name in names))
+
+
+class FeedPaginator(Paginator):
+    '''Пейджинатор ленты с подключаемой стратегией подсчёта.
+
+    count_key — хранить количество в кэше (FEED_COUNT_TIMEOUT секунд),
+    сбрасывается сигналами при создании и удалении постов.
+    estimate — для больших таблиц считать по диапазону id без COUNT(*).
+    Неточное количество уточняется по фактически выбранной странице,
+    поэтому ссылки «Предыдущая» / «Следующая» остаются верными.
+    '''
+
+    def __init__(self, object_list, per_page, count_key=None,
+                 estimate=False):
+        super().__init__(object_list, per_page)
+        self.count_key = count_key
+        self.estimate = estimate
+
+    @cached_property
+    def count(self):
+        if self.count_key is None:
+            return self._compute_count()
+        key = feed_count_key(self.count_key)
+        count = cache.get(key)
+        if count is None:
+            count = self._compute_count()
+            cache.set(key, count, FEED_COUNT_TIMEOUT)
+        return count
+
+    def _compute_count(self):
+        '''Ниже COUNT_ESTIMATE_FROM — точный COUNT по LIMIT-подзапросу,
+        выше — оценка по диапазону id, без полного прохода.'''
+        if not self.estimate:
+            return self.object_list.count()
+        bounded = self.object_list.order_by()[:COUNT_ESTIMATE_FROM].count()
+        if bounded < COUNT_ESTIMATE_FROM:
+            return bounded
+        span = self.object_list.aggregate(low=Min('id'), high=Max('id'))
+        return max(span['high'] - span['low'] + 1, bounded)
+
+    def _correct_count(self, count):
+        self.__dict__['count'] = count
+        self.__dict__.pop('num_pages', None)
+        if self.count_key is not None:
+            cache.set(
+                feed_count_key(self.count_key), count, FEED_COUNT_TIMEOUT)
+
+    def validate_number(self, number):
+        '''Верхнюю границу проверяет page(): количество может быть неточным.'''
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            return super().validate_number(number)
+        if number < 1:
+            return super().validate_number(number)
+        return number
+
+    def get_page(self, number):
+        '''Как в Paginator: номер за концом — последняя страница, но по
+        количеству, которое page() уточнил по выборке.'''
+        try:
+            return super().get_page(number)
+        except EmptyPage:
+            return self.page(self.num_pages)
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not rows and number > 1:
+            if self.estimate and self.count >= COUNT_ESTIMATE_FROM:
+                return self._tail_page(min(number, self.num_pages))
+            self._correct_count(self.object_list.count())
+            raise EmptyPage('Эта страница не содержит результатов')
+        known = bottom + len(rows)
+        exact = len(rows) <= self.per_page
+        if (exact and self.count != known) or self.count < known:
+            self._correct_count(known)
+        return self._get_page(rows[:self.per_page], number, self)
+
+    def _tail_page(self, number):
+        '''Номер за концом оценённой ленты: последние per_page постов
+        одним запросом в обратном порядке, без COUNT(*).
+
+        Оценка по id завышает количество при дырах в id, поэтому номер
+        становится последней страницей, а количество только уменьшается.
+        Соседние страницы в таком режиме открываются по курсору,
+        см. attach_cursors().
+        '''
+        rows = list(self.object_list.reverse()[:self.per_page])
+        if not rows:
+            self._correct_count(0)
+            raise EmptyPage('Эта страница не содержит результатов')
+        rows.reverse()
+        self._correct_count((number - 1) * self.per_page + len(rows))
+        return self._get_page(rows, number, self)
+
+    def snapshot(self):
+        '''Состояние, по которому страница восстанавливается из кэша.'''
+        return {'count': self.count}
+
+    def restore(self, state):
+        self.__dict__.update(state)
+
+
+# id курсора попадает в SQL как есть: за пределами BIGINT база падает
+# с OverflowError.
+MIN_CURSOR_ID = -2 ** 63
+MAX_CURSOR_ID = 2 ** 63 - 1
+
+
+def encode_cursor(obj, date_field='pub_date'):
+    '''Непрозрачный курсор для ?after= / ?before=: пара (дата, id).'''
+    raw = f'{getattr(obj, date_field).isoformat()}|{obj.id}'
+    return urlsafe_base64_encode(force_bytes(raw))
+
+
+def decode_cursor(token):
+    '''Разбирает курсор. Для битого токена и id вне 64-битного
+    диапазона базы возвращает None.'''
+    try:
+        date, object_id = force_str(
+            urlsafe_base64_decode(token)).split('|')
+        date, object_id = datetime.fromisoformat(date), int(object_id)
+    except (ValueError, TypeError):
+        return None
+    if not MIN_CURSOR_ID <= object_id <= MAX_CURSOR_ID:
+        return None
+    return date, object_id
+
+
+class KeysetPaginator(Paginator):
+    '''Пейджинатор по курсору (pub_date, id) без LIMIT/OFFSET.
+
+    date_field — поле даты курсора, например created для комментариев.
+
+    Страница N стоит столько же, сколько первая: выборка — это один
+    диапазон по индексу. Количество страниц заранее неизвестно, поэтому
+    нумерация «виртуальная»: номер 2, если есть предыдущая страница,
+    и num_pages на единицу больше, если есть следующая.
+    '''
+
+    def __init__(self, object_list, per_page, after=None, before=None,
+                 id_field='id', date_field='pub_date'):
+        if object_list is not None:
+            object_list = object_list.order_by(
+                f'-{date_field}', f'-{id_field}')
+        super().__init__(object_list, per_page)
+        self.after = after
+        self.before = before
+        self.id_field = id_field
+        self.date_field = date_field
+        self._has_previous = False
+        self._has_next = False
+
+    @property
+    def count(self):
+        return None
+
+    @property
+    def num_pages(self):
+        return (2 if self._has_previous else 1) + int(self._has_next)
+
+    def _slice(self, queryset, id_field, limit):
+        '''Первые limit строк после курсора;
+        перед курсором — по возрастанию.'''
+        date_field = self.date_field
+        queryset = queryset.order_by(f'-{date_field}', f'-{id_field}')
+        if self.before is not None:
+            date, object_id = self.before
+            queryset = queryset.filter(
+                Q(**{f'{date_field}__gt': date})
+                | Q(**{date_field: date, f'{id_field}__gt': object_id})
+            ).reverse()
+        elif self.after is not None:
+            date, object_id = self.after
+            queryset = queryset.filter(
+                Q(**{f'{date_field}__lt': date})
+                | Q(**{date_field: date, f'{id_field}__lt': object_id})
+            )
+        return list(queryset[:limit])
+
+    def _fetch(self, limit):
+        return self._slice(self.object_list, self.id_field, limit)
+
+    def page(self, number=None):
+        rows = self._fetch(self.per_page + 1)
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if self.before is not None:
+            rows.reverse()
+            self._has_previous, self._has_next = has_more, True
+        else:
+            self._has_previous = self.after is not None
+            self._has_next = has_more
+        return Page(rows, 2 if self._has_previous else 1, self)
+
+    def get_page(self, number=None):
+        return self.page(number)
+
+    def snapshot(self):
+        '''Состояние, по которому страница восстанавливается из кэша.'''
+        return {
+            '_has_previous': self._has_previous,
+            '_has_next': self._has_next,
+        }
+
+    def restore(self, state):
+        self.__dict__.update(state)
+
+
+class MergedKeysetPaginator(KeysetPaginator):
+    '''Ограниченное k-way слияние нескольких лент по (pub_date, id).
+
+    sources — пары (queryset, through), как в pager_list. Из каждого
+    источника берётся не больше per_page + 1 строк после курсора,
+    повторяющиеся посты отбрасываются.
+    '''
+
+    def __init__(self, sources, per_page, after=None, before=None):
+        super().__init__(None, per_page, after=after, before=before)
+        self.sources = sources
+
+    def _fetch(self, limit):
+        streams = []
+        for queryset, through in self.sources:
+            id_field = 'id' if through is None else f'{through}_id'
+            rows = self._slice(queryset, id_field, limit)
+            if through is not None:
+                rows = [getattr(row, through) for row in rows]
+            streams.append(rows)
+        seen = set()
+        merged = []
+        for post in heapq.merge(
+                *streams, key=lambda post: (post.pub_date, post.id),
+                reverse=self.before is None):
+            if post.id not in seen:
+                seen.add(post.id)
+                merged.append(post)
+            if len(merged) == limit:
+                break
+        return merged
+
+
+def page_window(number, num_pages, on_each_side=PAGE_WINDOW_ON_EACH_SIDE,
+                on_ends=PAGE_WINDOW_ON_ENDS):
+    '''Номера страниц вокруг текущей, первые и последние; None — пропуск.
+
+    Полный page_range не строится: размер окна не зависит от num_pages.
+    '''
+    window_start = max(number - on_each_side, 1)
+    window_end = min(number + on_each_side, num_pages)
+    if window_start > on_ends + 1:
+        yield from range(1, on_ends + 1)
+        yield None
+    else:
+        window_start = 1
+    if window_end < num_pages - on_ends:
+        yield from range(window_start, window_end + 1)
+        yield None
+        yield from range(num_pages - on_ends + 1, num_pages + 1)
+    else:
+        yield from range(window_start, num_pages + 1)
+
+
+def attach_cursors(page_obj):
+    '''Добавляет странице курсоры соседних страниц и окно номеров.
+
+    «Предыдущая» / «Следующая» ведут по курсору в режиме KeysetPaginator
+    и для лент, где страниц больше MAX_NUMBERED_PAGES.
+    '''
+    page_obj.use_cursors = (
+        isinstance(page_obj.paginator, KeysetPaginator)
+        or page_obj.paginator.num_pages > MAX_NUMBERED_PAGES
+    )
+    page_obj.page_window = list(
+        page_window(page_obj.number, page_obj.paginator.num_pages))
+    page_obj.next_cursor = None
+    page_obj.previous_cursor = None
+    date_field = getattr(page_obj.paginator, 'date_field', 'pub_date')
+    objects = list(page_obj.object_list)
+    if objects and page_obj.has_next():
+        page_obj.next_cursor = encode_cursor(objects[-1], date_field)
+    if objects and page_obj.has_previous():
+        page_obj.previous_cursor = encode_cursor(objects[0], date_field)
+    return page_obj
+
+
+def cached_page(request, paginator, feed):
+    '''Страница ленты feed из закэшированного списка id.
+
+    В кэше лежат только упорядоченные id страницы и состояние
+    пейджинатора — под версией состава ленты, общие для всех
+    пользователей. Посты собирает hydrate_posts() из кэша объектов,
+    поэтому правка поста сбрасывает одну запись, а не списки.
+    '''
+    version, = feed_versions([members_feed(feed)])
+    window = '|'.join(
+        request.GET.get(param, '') for param in ('page', 'after', 'before'))
+    key = f'feed_ids:{feed}:{version}:{md5(window.encode()).hexdigest()}'
+    cached = cache.get(key)
+    if cached is None:
+        paginator.object_list = paginator.object_list.select_related(
+            None).only('id', 'pub_date')
+        page_obj = paginator.get_page(request.GET.get('page'))
+        ids = [post.id for post in page_obj.object_list]
+        cache.set(
+            key, (ids, page_obj.number, paginator.snapshot()),
+            FEED_IDS_TIMEOUT)
+    else:
+        ids, number, state = cached
+        paginator.restore(state)
+        page_obj = Page(ids, number, paginator)
+    page_obj.object_list = hydrate_posts(ids)
+    return page_obj
+
+
+def pager_list(request, page_list, VIEW_LIST, count_key=None,
+               estimate=False, through=None, cache_ids=False):
+    '''Пейджинатор, то есть постраничное разбиение списка постов.
+
+    С ?after= или ?before= работает по курсору (KeysetPaginator),
+    иначе — обычная нумерация ?page= (FeedPaginator).
+    through — имя связи с Post, если разбивается не Post, а, например,
+    TimelineEntry с собственным pub_date: на странице окажутся посты.
+    cache_ids — брать страницу ленты count_key из кэша id, см. cached_page().
+    '''
+    id_field = 'id' if through is None else f'{through}_id'
+    after = decode_cursor(request.GET.get('after', ''))
+    before = decode_cursor(request.GET.get('before', ''))
+    if after is not None or before is not None:
+        paginator = KeysetPaginator(
+            page_list, VIEW_LIST, after=after, before=before,
+            id_field=id_field)
+    else:
+        paginator = FeedPaginator(
+            page_list.order_by('-pub_date', f'-{id_field}'), VIEW_LIST,
+            count_key=count_key, estimate=estimate)
+    if cache_ids:
+        return attach_cursors(cached_page(request, paginator, count_key))
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
+    if through is not None:
+        page_obj.object_list = [
+            getattr(entry, through) for entry in page_obj.object_list]
 
-    return page_obj
+    return attach_cursors(page_obj)
+
+
+def merged_pager_list(request, sources, VIEW_LIST):
+    '''Постраничное слияние нескольких лент, только по курсору.'''
+    paginator = MergedKeysetPaginator(
+        sources, VIEW_LIST,
+        after=decode_cursor(request.GET.get('after', '')),
+        before=decode_cursor(request.GET.get('before', '')))
+
+    return attach_cursors(paginator.page())
+
+
+def comments_page(request, comments, per_page):
+    '''Страница комментариев: от новых к старым, дальше — по ?after=.'''
+    paginator = KeysetPaginator(
+        comments, per_page, after=decode_cursor(request.GET.get('after', '')),
+        date_field='created')
+
+    return attach_cursors(paginator.page())
@@ -1,20 +1,32 @@
+from django.http import Http404
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.core.cache import cache
-from django.views.decorators.cache import cache_page
 
-from .models import Post, Group, User, Follow
+from core.query_budget import query_budget
+from .models import Post, User, Follow
+from .caching import (
+    cache_feed, conditional_feed, group_feeds, post_detail_feeds,
+    profile_feeds, requested_author, requested_group, requested_post
+)
 from .forms import PostForm, CommentForm
-from .utils import pager_list
-from posts.constants import VIEW_LIST_COUNT_OF_PAGINATOR as VIEW_LIST
-
-
-@cache_page(20, key_prefix='index_page')
+from .stats import stats_for
+from .thumbnails import queue_thumbnails
+from .timeline import pull_authors
+from .utils import comments_page, pager_list, merged_pager_list
+from posts.constants import (
+    VIEW_LIST_COUNT_OF_PAGINATOR as VIEW_LIST, COMMENTS_PER_PAGE
+)
+
+
+@conditional_feed(feeds=('index',))
+@cache_feed(feeds=('index',))
+@query_budget(6)
 def index(request):
     '''Вьювс главной страницы: постранично по десять публикаций.'''
     template = 'posts/index.html'
-    post_list = Post.objects.select_related('group')
-    page_obj = pager_list(request, post_list, VIEW_LIST)
+    page_obj = pager_list(
+        request, Post.objects.all(), VIEW_LIST, count_key='index',
+        estimate=True, cache_ids=True)
     context = {
         'page_obj': page_obj,
     }
@@ -22,12 +34,18 @@ def index(request):
     return render(request, template, context)
 
 
+@conditional_feed(feeds=group_feeds)
+@cache_feed(feeds=group_feeds)
+@query_budget(7)
 def group_posts(request, slug):
     '''Вьювс групп: постранично по десять публикаций группы.'''
     template = 'posts/group_list.html'
-    group = get_object_or_404(Group, slug=slug)
-    post_list = group.posts.select_related('author')
-    page_obj = pager_list(request, post_list, VIEW_LIST)
+    group = requested_group(request, slug)
+    if group is None:
+        raise Http404('Группа не найдена')
+    page_obj = pager_list(
+        request, Post.objects.filter(group=group), VIEW_LIST,
+        count_key=f'group:{group.id}', cache_ids=True)
     context = {
         'group': group,
         'page_obj': page_obj,
@@ -36,32 +54,49 @@ def group_posts(request, slug):
     return render(request, template, context)
 
 
+@conditional_feed(feeds=profile_feeds)
+@query_budget(10)
 def profile(request, username):
     '''Вьювс автора: постранично по десять публикаций.'''
     template = 'posts/profile.html'
-    author = get_object_or_404(User, username=username)
+    author = requested_author(request, username)
+    if author is None:
+        raise Http404('Автор не найден')
     following = False
     if request.user.is_authenticated:
         following = request.user.follower.filter(author=author).exists()
-    post_list = author.posts.all()
-    page_obj = pager_list(request, post_list, VIEW_LIST)
+    page_obj = pager_list(
+        request, Post.objects.filter(author=author), VIEW_LIST,
+        count_key=f'author:{author.id}', cache_ids=True)
+    author_stats = stats_for(author.id)
     context = {
         'author': author,
+        'author_stats': author_stats,
         'page_obj': page_obj,
         'following': following,
     }
+    if request.user == author:
+        context['user_stats'] = author_stats
+    elif request.user.is_authenticated:
+        context['user_stats'] = stats_for(request.user.id)
 
     return render(request, template, context)
 
 
+@conditional_feed(feeds=post_detail_feeds)
+@query_budget(6)
 def post_detail(request, post_id):
     '''Вьювс публикации.'''
     template = 'posts/post_detail.html'
-    post = get_object_or_404(Post, id=post_id)
-    comments = post.comments.all()
+    post = requested_post(request, post_id)
+    if post is None:
+        raise Http404('Пост не найден')
+    comments = comments_page(
+        request, post.comments.select_related('author'), COMMENTS_PER_PAGE)
     form = CommentForm()
     context = {
         'post': post,
+        'author_stats': stats_for(post.author_id),
         'comments': comments,
         'form': form
     }
@@ -69,6 +104,24 @@ def post_detail(request, post_id):
     return render(request, template, context)
 
 
+@conditional_feed(feeds=post_detail_feeds)
+@query_budget(5)
+def post_comments(request, post_id):
+    '''Фрагмент со следующей страницей комментариев, для «Показать ещё».'''
+    template = 'posts/includes/comments.html'
+    post = requested_post(request, post_id)
+    if post is None:
+        raise Http404('Пост не найден')
+    context = {
+        'post': post,
+        'comments': comments_page(
+            request, post.comments.select_related('author'),
+            COMMENTS_PER_PAGE),
+    }
+
+    return render(request, template, context)
+
+
 @login_required
 def post_create(request):
     '''Вьювс создание нового поста.'''
@@ -81,6 +134,7 @@ def post_create(request):
         post = form.save(commit=False)
         post.author = request.user
         form.save()
+        queue_thumbnails(post.image)
         return redirect('posts:profile', post.author)
     context = {
         'form': form,
@@ -105,7 +159,8 @@ def post_edit(request, post_id):
     )
     if form.is_valid():
         form.save()
-        cache.clear()
+        if 'image' in form.changed_data:
+            queue_thumbnails(post.image)
         return redirect('posts:post_detail', post_id)
     context = {
         'post': post,
@@ -131,14 +186,28 @@ def add_comment(request, post_id):
 
 
 @login_required
+@query_budget(7)
 def follow_index(request):
     '''Посты, на которых подписан пользователь:
         постранично по десять публикаций.'''
     template = 'posts/follow.html'
-    post_list = Post.objects.filter(author__following__user=request.user)
-    page_obj = pager_list(request, post_list, VIEW_LIST)
+    post_list = request.user.timeline.select_related(
+        'post__author', 'post__group')
+    pulled = pull_authors(request.user)
+    if pulled:
+        sources = [
+            (post_list, 'post'),
+            (Post.objects.filter(author_id__in=pulled).select_related(
+                'author', 'group'), None),
+        ]
+        page_obj = merged_pager_list(request, sources, VIEW_LIST)
+    else:
+        page_obj = pager_list(
+            request, post_list, VIEW_LIST,
+            count_key=f'follow:{request.user.id}', through='post')
     context = {
         'page_obj': page_obj,
+        'user_stats': stats_for(request.user.id),
     }
 
     return render(request, template, context)
@@ -18,15 +18,49 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Медиа раздаёт core.media.serve_media. Имена картинок и миниатюр —
+# хэши содержимого, поэтому браузер может кэшировать их надолго.
+# MEDIA_SENDFILE: None — файл отдаёт приложение через sendfile,
+# 'x-accel-redirect' — nginx (из MEDIA_ACCEL_PREFIX), 'x-sendfile' — Apache.
+MEDIA_CACHE_MAX_AGE = 60 * 60 * 24 * 365
+MEDIA_SENDFILE = None
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+
 LOGIN_URL = 'users:login'
 LOGIN_REDIRECT_URL = 'posts:first'
 
+# Кэш общий для всех воркеров хоста: файл SQLite вместо LocMemCache.
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'BACKEND': 'core.cache.SQLiteCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'default.sqlite3'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
     }
 }
 
+# Кэш страниц лент (posts.caching.cache_feed): fresh — секунд ответ свежий,
+# stale — сколько ещё отдавать устаревший ответ, пока он пересчитывается
+# в фоне, slugs — кэшировать только эти группы (без ключа — все).
+FEED_CACHE = {
+    'index': {'fresh': 20, 'stale': 120},
+    'group_posts': {'fresh': 30, 'stale': 300},
+}
+FEED_REFRESH_WORKERS = 2
+
+# Авторы, у которых подписчиков не меньше порога, не раскладывают посты
+# по лентам подписчиков: их посты подмешиваются при чтении ленты.
+TIMELINE_PULL_THRESHOLD = 10000
+
+# Миниатюры создаются в фоне после загрузки картинки, а не при рендере,
+# см. posts.thumbnails.
+THUMBNAIL_BACKEND = 'posts.thumbnails.QueuedThumbnailBackend'
+THUMBNAIL_WORKERS = 2
+
+# Куда export_snapshots складывает статические копии анонимных страниц.
+SNAPSHOT_ROOT = os.path.join(BASE_DIR, 'snapshots')
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.0/howto/deployment/checklist/
 
@@ -34,7 +68,9 @@ CACHES = {
 SECRET_KEY = 'django-insecure-m%l_-*9ot7o)iu84j2!pp6%$(!@gibr77mzzd1^h_gp(i!3rze'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# На сервере задайте DJANGO_DEBUG=0: только тогда включаются cached.Loader
+# для шаблонов и отключается проверка бюджета запросов.
+DEBUG = os.environ.get('DJANGO_DEBUG', '1') != '0'
 
 ALLOWED_HOSTS = [
     'localhost',
@@ -70,15 +106,29 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+if DEBUG:
+    MIDDLEWARE.insert(0, 'core.middleware.QueryBudgetMiddleware')
+
 ROOT_URLCONF = 'yatube.urls'
 TEMPLATES_DIR = os.path.join(BASE_DIR, 'templates')
 
+TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+if not DEBUG:
+    # Боевой режим: шаблон компилируется один раз на процесс,
+    # yatube/wsgi.py компилирует все шаблоны до первого запроса.
+    TEMPLATE_LOADERS = [
+        ('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),
+    ]
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [TEMPLATES_DIR],
-        'APP_DIRS': True,
         'OPTIONS': {
+            'loaders': TEMPLATE_LOADERS,
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -13,10 +13,13 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
 from django.contrib import admin
-from django.urls import include, path
+from django.urls import include, path, re_path
 from django.conf import settings
-from django.conf.urls.static import static
+
+from core.media import serve_media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -30,7 +33,10 @@ handler404 = 'core.views.page_not_found'
 handler500 = 'core.views.internal_server_error'
 handler403 = 'core.views.permission_denied'
 
-if settings.DEBUG:
-    urlpatterns += static(
-        settings.MEDIA_URL, document_root=settings.MEDIA_ROOT
-    )
+if settings.MEDIA_URL.startswith('/'):
+    urlpatterns += [
+        re_path(
+            r'^%s(?P<path>.+)$' % re.escape(settings.MEDIA_URL.lstrip('/')),
+            serve_media, name='media'
+        ),
+    ]